@@ -0,0 +1,310 @@
+import io
+import os
+import time
+import pickle
+import hashlib
+import threading
+import functools
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pygeos
+from pyarrow.lib import ArrowException
+
+import instrumentation
+import utils
+
+# In-memory tier, bounded by the estimated size of the cached results rather than by entry count
+CACHE_MEMORY_BYTES = int(os.environ.get('CACHE_MEMORY_MB', 512)) * 1024 * 1024
+# Disk tier, shared by every process running from the same directory
+CACHE_DIR = os.environ.get('CACHE_DIR', 'Output/cache')
+CACHE_DISK_BYTES = int(os.environ.get('CACHE_DISK_MB', 4096)) * 1024 * 1024
+# Table versions are re-read from the database at most this often (seconds)
+VERSION_TTL = 30
+# Tables without a version row (loaded outside the versioned writers) expire after this long instead (seconds)
+UNVERSIONED_TTL = 1200
+# Rows written and read back to check a frame survives Parquet before it is stored that way
+ROUND_TRIP_ROWS = 100
+
+
+class MemoryCache(object):
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        return self.get_entry(key)[0]
+
+    def get_entry(self, key: str) -> tuple:
+        # (value, size recorded at put time), or (None, None)
+        with self._lock:
+            if key not in self._entries:
+                return None, None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key: str, value, size: int):
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                # Too large to keep; the entry it replaces is stale, so it goes too
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+def _first_values(df: pd.DataFrame) -> list:
+    # Type of the first non-null value of every object column
+    types = []
+    for i, dtype in enumerate(df.dtypes):
+        if dtype == object:
+            values = df.iloc[:, i].dropna()
+            types.append(type(values.iloc[0]) if len(values) else None)
+    return types
+
+
+def parquet_round_trips(df: pd.DataFrame) -> bool:
+    # Writes the first rows to Parquet in memory and reads them back. Frames whose class, dtypes or object
+    # values change on the way (GeoDataFrames, coordinate lists that come back as numpy arrays, geometries)
+    # are pickled instead.
+    if type(df) is not pd.DataFrame:
+        return False
+    sample = df.head(ROUND_TRIP_ROWS)
+    buffer = io.BytesIO()
+    try:
+        sample.to_parquet(buffer)
+        buffer.seek(0)
+        back = pd.read_parquet(buffer)
+    except (TypeError, ValueError, ImportError, ArrowException):
+        return False
+    return (type(back) is pd.DataFrame and list(back.columns) == list(sample.columns)
+            and list(back.dtypes) == list(sample.dtypes) and _first_values(back) == _first_values(sample))
+
+
+class DiskCache(object):
+    # DataFrames are stored as Parquet when they survive the round trip unchanged; anything else is pickled
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _files(self, key: str) -> list:
+        return [os.path.join(self.path, key + ext) for ext in ('.parquet', '.pk')]
+
+    def get(self, key: str):
+        for file_path in self._files(key):
+            try:
+                if file_path.endswith('.parquet'):
+                    value = pd.read_parquet(file_path)
+                else:
+                    with open(file_path, 'rb') as f:
+                        value = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                continue
+            os.utime(file_path)
+            return value
+        return None
+
+    def put(self, key: str, value):
+        parquet_path, pickle_path = self._files(key)
+        tmp_path = f'{parquet_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            try:
+                if not (isinstance(value, pd.DataFrame) and parquet_round_trips(value)):
+                    raise TypeError
+                value.to_parquet(tmp_path)
+                os.replace(tmp_path, parquet_path)
+            except (TypeError, ValueError, ImportError, ArrowException):
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, pickle_path)
+            self.evict()
+        except OSError as e:
+            print(f'Could not write cache entry {key}: {e}')
+
+    def evict(self):
+        # Least recently used files go first; hits touch their file's mtime
+        with self._lock:
+            files = []
+            for entry in os.scandir(self.path):
+                if entry.name.endswith(('.parquet', '.pk')):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in files)
+            for _, size, file_path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    pass
+                total -= size
+
+    def clear(self):
+        if os.path.isdir(self.path):
+            for entry in os.scandir(self.path):
+                os.remove(entry.path)
+
+
+memory_cache = MemoryCache(CACHE_MEMORY_BYTES)
+disk_cache = DiskCache(CACHE_DIR, CACHE_DISK_BYTES)
+
+_versions = {}
+_versions_lock = threading.Lock()
+
+
+def table_versions(tables: list) -> dict:
+    # Versions come from the snapshot manifest when reads are served from one, otherwise from the
+    # table_versions table that queries.bump_table_versions() updates after every write
+    import queries
+    import snapshot
+    manifest = snapshot.load_manifest()
+    if manifest is not None:
+        return {t: manifest['tables'].get(t, {}).get('version', manifest['created']) for t in tables}
+
+    now = time.monotonic()
+    with _versions_lock:
+        missing = [t for t in tables if t not in _versions or now - _versions[t][1] > VERSION_TTL]
+    if missing:
+        fetched = queries.table_versions_query(missing)
+        with _versions_lock:
+            for t in missing:
+                _versions[t] = (fetched.get(t), now)
+    # Without a version row the key changes every UNVERSIONED_TTL seconds, so such entries still expire
+    expiry = f'ttl-{int(time.time() // UNVERSIONED_TTL)}'
+    with _versions_lock:
+        return {t: _versions[t][0] if _versions[t][0] is not None else expiry for t in tables}
+
+
+def forget_versions(tables: list = None):
+    with _versions_lock:
+        if tables is None:
+            _versions.clear()
+        for t in tables or []:
+            _versions.pop(t, None)
+
+
+def _payload_size(series: pd.Series) -> int:
+    # memory_usage(deep=True) counts a geometry or a coordinate list at its sys.getsizeof, a few dozen bytes
+    # whatever its size, so these columns are measured by their WKB or pickled length instead
+    values = series.dropna()
+    if values.empty:
+        return 0
+    first = values.iloc[0]
+    if isinstance(first, pygeos.Geometry) or hasattr(first, '__geo_interface__'):
+        geoms = np.asarray(values, dtype=object) if isinstance(first, pygeos.Geometry) \
+            else utils.geoms_from_shapely(values)
+        return int(sum(len(wkb) for wkb in pygeos.to_wkb(geoms)))
+    if isinstance(first, (list, tuple, dict)):
+        return len(pickle.dumps(values.to_list(), protocol=pickle.HIGHEST_PROTOCOL))
+    return 0
+
+
+def _size(value) -> int:
+    if isinstance(value, pd.DataFrame):
+        size = int(value.memory_usage(index=True, deep=True).sum())
+        for i, dtype in enumerate(value.dtypes):
+            if dtype == object or dtype.name == 'geometry':
+                size += _payload_size(value.iloc[:, i])
+        return size
+    return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def _copy(value):
+    # Callers mutate their results in place (renames, fillna), so cached objects are never handed out
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.copy()
+    if isinstance(value, (dict, list)):
+        return pickle.loads(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    return value
+
+
+def _lookup(key: str, disk: bool) -> tuple:
+    # (value, size, tier) of a cached entry; value is None on a miss
+    value, size = memory_cache.get_entry(key)
+    if value is not None:
+        return value, size, 'memory'
+    if disk:
+        value = disk_cache.get(key)
+        if value is not None:
+            size = _size(value)
+            memory_cache.put(key, value, size)
+            return value, size, 'disk'
+    return None, None, 'miss'
+
+
+def _store(key: str, value, disk: bool) -> int:
+    size = _size(value)
+    memory_cache.put(key, value, size)
+    if disk:
+        disk_cache.put(key, value)
+    return size
+
+
+def cached(tables, disk: bool = True):
+    # `tables` lists the tables a function reads, or is a callable receiving the function's arguments and
+    # returning them. Their versions are part of the key, so writes invalidate exactly the affected entries.
+    # The wrapper's `lookup` and `store` let callers that fetch several entries in one query (see
+    # queries.county_columns_query) read and fill the cache without calling the function.
+    def decorator(func):
+        name = f'{func.__module__}.{func.__qualname__}'
+
+        def key_for(args, kwargs) -> str:
+            source_tables = tables(*args, **kwargs) if callable(tables) else tables
+            versions = table_versions(sorted(set(source_tables)))
+            key_str = repr((func.__module__, func.__qualname__, args, sorted(kwargs.items()),
+                            sorted(versions.items())))
+            return hashlib.sha1(key_str.encode()).hexdigest()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with instrumentation.call(name) as entry:
+                key = key_for(args, kwargs)
+                value, size, entry['cache'] = _lookup(key, disk)
+                if value is None:
+                    value = func(*args, **kwargs)
+                    size = _store(key, value, disk)
+                # The size measured when the entry was stored, so hits don't rescan the frame
+                entry.update(instrumentation.measure(value, size))
+                return _copy(value)
+
+        def lookup(*args, **kwargs):
+            # Cached result for these arguments, or None without calling the function
+            value = _lookup(key_for(args, kwargs), disk)[0]
+            return None if value is None else _copy(value)
+
+        def store(value, *args, **kwargs):
+            # Caches `value` as the result for these arguments
+            _store(key_for(args, kwargs), value, disk)
+
+        wrapper.lookup = lookup
+        wrapper.store = store
+        return wrapper
+    return decorator
+
+
+def dataset_key(name: str, parts: tuple, tables: list) -> str:
+    # Key for caches of derived data that live outside `cached` (e.g. correlation matrices): what selects the
+    # dataset plus the versions of the tables it was read from, so writes invalidate it
+    versions = table_versions(sorted(set(tables)))
+    key_str = repr((parts, sorted(versions.items())))
+    return f'{name}:' + hashlib.sha1(key_str.encode()).hexdigest()
+
+
+def clear():
+    memory_cache.clear()
+    disk_cache.clear()
+    forget_versions()
@@ -0,0 +1,113 @@
+import hashlib
+import numpy as np
+import pandas as pd
+
+from cache import MemoryCache
+from constants import BREAKS, COLOR_RANGE
+
+EQUAL_INTERVAL = 'Equal interval'
+QUANTILE = 'Quantile'
+NATURAL_BREAKS = 'Natural breaks (Jenks)'
+SCHEMES = [EQUAL_INTERVAL, QUANTILE, NATURAL_BREAKS]
+DEFAULT_SCHEME = EQUAL_INTERVAL
+
+# Natural breaks are computed on at most this many evenly spaced quantiles of the data; the optimisation
+# is quadratic in the number of values
+JENKS_SAMPLE = 1000
+# Categories cycle through the first ten colors, as the enumerated categories did with color_scale
+CATEGORY_COLORS = 10
+
+_breaks_cache = MemoryCache(64 * 1024 * 1024)
+
+
+def equal_interval_breaks(values: np.ndarray, n: int) -> np.ndarray:
+    # With the default n this is constants.BREAKS stretched over the range of the data, the same classes
+    # color_scale gave min-max scaled values
+    lo, hi = values.min(), values.max()
+    steps = np.asarray(BREAKS, dtype=float) if n == len(BREAKS) else np.linspace(0, 1, n)
+    return lo + (hi - lo) * steps
+
+
+def quantile_breaks(values: np.ndarray, n: int) -> np.ndarray:
+    return np.quantile(values, np.linspace(0, 1, n + 1)[1:])
+
+
+def jenks_breaks(values: np.ndarray, n: int) -> np.ndarray:
+    # Fisher's exact optimisation of Jenks natural breaks: minimises the summed squared deviation within
+    # classes, one class at a time over every possible start of the last class
+    x = np.sort(values)
+    if len(x) > JENKS_SAMPLE:
+        x = np.quantile(x, np.linspace(0, 1, JENKS_SAMPLE))
+    n = min(n, len(np.unique(x)))
+    m = len(x)
+    s1 = np.concatenate([[0], np.cumsum(x)])
+    s2 = np.concatenate([[0], np.cumsum(x * x)])
+    start, end = np.triu_indices(m)
+    ssd = np.full((m, m), np.inf)
+    count = end - start + 1
+    ssd[start, end] = (s2[end + 1] - s2[start]) - (s1[end + 1] - s1[start]) ** 2 / count
+
+    cost = ssd[0].copy()
+    last_start = np.zeros((n, m), dtype=int)
+    for c in range(1, n):
+        # total[i, j]: classes 0..c-1 cover x[:i] and class c covers x[i:j + 1]
+        total = np.full((m, m), np.inf)
+        total[1:] = cost[:-1, None] + ssd[1:]
+        last_start[c] = total.argmin(axis=0)
+        cost = total.min(axis=0)
+
+    upper = np.empty(n)
+    j = m - 1
+    for c in range(n - 1, 0, -1):
+        upper[c] = x[j]
+        j = last_start[c, j] - 1
+    upper[0] = x[j]
+    return upper
+
+
+SCHEME_BREAKS = {
+    EQUAL_INTERVAL: equal_interval_breaks,
+    QUANTILE: quantile_breaks,
+    NATURAL_BREAKS: jenks_breaks,
+}
+
+
+def breaks(values: pd.Series, scheme: str = DEFAULT_SCHEME, n: int = len(COLOR_RANGE)) -> np.ndarray:
+    # Upper bound of each class, cached per feature and dataset: the key includes a digest of the values, so
+    # switching back to a feature already shown (or to another scheme) doesn't recompute anything
+    finite = pd.to_numeric(values, errors='coerce').to_numpy(dtype=float)
+    finite = finite[np.isfinite(finite)]
+    if len(finite) == 0:
+        return np.zeros(1)
+    key = hashlib.md5(finite.tobytes()).hexdigest()
+    key = f'{values.name}|{scheme}|{n}|{key}'
+    result = _breaks_cache.get(key)
+    if result is None:
+        result = SCHEME_BREAKS[scheme](finite, n)
+        _breaks_cache.put(key, result, result.nbytes + len(key))
+    return result
+
+
+def class_indices(values: pd.Series, upper: np.ndarray) -> np.ndarray:
+    # Class of every value in one searchsorted: the first class whose upper bound is >= the value, as
+    # color_scale's `val <= b` scan. Missing values fall into the last class, as they did there.
+    numbers = pd.to_numeric(values, errors='coerce').to_numpy(dtype=float)
+    return np.minimum(np.searchsorted(upper, numbers, side='left'), len(upper) - 1)
+
+
+def color_indices(values: pd.Series, scheme: str = DEFAULT_SCHEME) -> np.ndarray:
+    if pd.api.types.is_numeric_dtype(values):
+        upper = breaks(values, scheme)
+        indices = class_indices(values, upper)
+        if len(upper) < len(COLOR_RANGE) and len(upper) > 1:
+            # Fewer classes than colors (few distinct values): spread them over the whole ramp
+            indices = np.rint(indices * (len(COLOR_RANGE) - 1) / (len(upper) - 1)).astype(int)
+        return indices
+    # Categories in order of appearance, missing values included as their own category
+    codes, _ = pd.factorize(values, na_sentinel=None)
+    return codes % CATEGORY_COLORS
+
+
+def fill_colors(values: pd.Series, scheme: str = DEFAULT_SCHEME) -> list:
+    # One [r, g, b] list per value, ready for a pydeck layer
+    return np.asarray(COLOR_RANGE)[color_indices(values, scheme)].tolist()
@@ -0,0 +1,152 @@
+import os
+import hashlib
+import threading
+import weakref
+import numpy as np
+import pandas as pd
+
+from cache import MemoryCache
+
+# Correlation matrices, with the column values they were computed from, kept per dataset
+CORRELATION_CACHE_BYTES = int(os.environ.get('CORRELATION_CACHE_MB', 256)) * 1024 * 1024
+
+_matrices = MemoryCache(CORRELATION_CACHE_BYTES)
+_lock = threading.Lock()
+# Only the threads working on a dataset hold its lock, so it goes away once they are done
+_key_locks = weakref.WeakValueDictionary()
+
+
+def _pairwise(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    # Pearson correlation of every column of x with every column of y over the rows where both are present,
+    # as DataFrame.corr computes it, from a handful of matrix products instead of one pass per pair
+    mx, my = (~np.isnan(x)).astype(float), (~np.isnan(y)).astype(float)
+    x0, y0 = np.nan_to_num(x), np.nan_to_num(y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n = mx.T @ my
+        sum_x, sum_y = x0.T @ my, mx.T @ y0
+        var_x = (x0 * x0).T @ my - sum_x ** 2 / n
+        var_y = mx.T @ (y0 * y0) - sum_y ** 2 / n
+        cov = x0.T @ y0 - sum_x * sum_y / n
+        r = cov / np.sqrt(var_x * var_y)
+    r[(n < 2) | (var_x <= 0) | (var_y <= 0)] = np.nan
+    return np.clip(r, -1, 1)
+
+
+class CorrelationMatrix(object):
+    # Pairwise-complete correlations between the numeric columns of one dataset. Columns are added
+    # incrementally: only the correlations involving the new columns are computed.
+    def __init__(self):
+        self.columns = []
+        self.skipped = set()
+        self.data = None
+        self.values = np.empty((0, 0))
+
+    def __contains__(self, column: str) -> bool:
+        return column in self.columns or column in self.skipped
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes + (self.data.nbytes if self.data is not None else 0)
+
+    def copy(self) -> 'CorrelationMatrix':
+        # add() replaces data and values rather than writing into them, so the arrays can be shared
+        matrix = CorrelationMatrix()
+        matrix.columns, matrix.skipped = list(self.columns), set(self.skipped)
+        matrix.data, matrix.values = self.data, self.values
+        return matrix
+
+    def add(self, df: pd.DataFrame):
+        # Rows of df must be in the same order as those of earlier additions
+        new = [c for c in df.columns if c not in self]
+        numeric = [c for c in new if pd.api.types.is_numeric_dtype(df[c]) and not pd.api.types.is_bool_dtype(df[c])]
+        self.skipped.update(set(new) - set(numeric))
+        if not numeric:
+            return
+        block = df[numeric].to_numpy(dtype=float, na_value=np.nan)
+        # Centring each column first keeps the sums of squares small, as the two-pass computation does
+        block = block - np.nanmean(block, axis=0) if len(block) else block
+        if self.data is not None and len(self.data) != len(block):
+            raise ValueError(f'Expected {len(self.data)} rows, got {len(block)}')
+        data = block if self.data is None else np.hstack([self.data, block])
+
+        corr = _pairwise(data, block)
+        k, b = len(self.columns), len(numeric)
+        values = np.empty((k + b, k + b))
+        values[:k, :k] = self.values
+        values[:, k:] = corr
+        values[k:, :k] = corr[:k].T
+        diagonal = np.arange(k, k + b)
+        values[diagonal, diagonal] = np.where(np.isnan(corr[diagonal, np.arange(b)]), np.nan, 1.0)
+
+        self.data, self.values = data, values
+        self.columns += numeric
+
+    def frame(self, columns: list = None) -> pd.DataFrame:
+        # Sub-matrix for `columns` (every column when None); non-numeric columns are left out
+        columns = self.columns if columns is None else [c for c in columns if c in self.columns]
+        positions = [self.columns.index(c) for c in columns]
+        return pd.DataFrame(self.values[np.ix_(positions, positions)], index=columns, columns=columns)
+
+    def top_k(self, column: str, k: int = 10, columns: list = None) -> pd.Series:
+        # The k columns (of `columns`, or of all) most strongly correlated, positively or negatively, with `column`
+        row = pd.Series(self.values[self.columns.index(column)], index=self.columns)
+        if columns is not None:
+            row = row[row.index.isin(columns)]
+        row = row.drop(column, errors='ignore').dropna()
+        return row.reindex(row.abs().sort_values(ascending=False).index[:k])
+
+
+def frame_key(df: pd.DataFrame, name: str = '') -> str:
+    # Identifies an in-memory frame by its contents, for callers without a cache.dataset_key. Hashing every
+    # value costs a pass over the frame, still far cheaper than the correlations themselves.
+    digest = hashlib.sha1(pd.util.hash_pandas_object(df).to_numpy().tobytes())
+    digest.update(repr(list(map(str, df.columns))).encode())
+    return f'{name}:{digest.hexdigest()}'
+
+
+class _KeyLock(object):
+    # threading.Lock can't be weakly referenced, so the per-dataset locks are wrapped
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+def _key_lock(key: str) -> _KeyLock:
+    with _lock:
+        lock = _key_locks.get(key)
+        if lock is None:
+            lock = _key_locks[key] = _KeyLock()
+        return lock
+
+
+def correlation_matrix(key: str, columns: list, load) -> CorrelationMatrix:
+    # Cached matrix for the dataset identified by `key`, extended with any of `columns` it doesn't have yet.
+    # load(columns) returns a DataFrame of just those columns, rows always in the same order. Loads for one
+    # dataset are serialised; other datasets don't wait on them. A cached matrix is never extended in place:
+    # callers may still be reading it, and the cache must account for the grown size.
+    with _key_lock(key):
+        matrix = _matrices.get(key)
+        if matrix is None:
+            matrix = CorrelationMatrix()
+        missing = [c for c in dict.fromkeys(columns) if c not in matrix]
+        if missing:
+            matrix = matrix.copy()
+            matrix.add(load(missing))
+            _matrices.put(key, matrix, matrix.nbytes)
+    return matrix
+
+
+def long_frame(corr: pd.DataFrame) -> pd.DataFrame:
+    # variable / variable2 / correlation rows, the shape the Altair heatmap takes
+    columns = list(corr.columns)
+    return pd.DataFrame({
+        'variable': np.repeat(columns, len(columns)),
+        'variable2': np.tile(columns, len(columns)),
+        'correlation': corr.to_numpy().ravel(),
+    })
@@ -1,59 +1,64 @@
 import streamlit as st
 
+import cache
+import datasets
+import geo_index
 import queries
 import utils
 import visualization
 from constants import STATES
 
 
+# Extra columns each data format divides by
+FORMAT_COLUMNS = {'Per Capita': ['Total Population'], 'Per Square Mile': ['sqmi']}
+
+
 def county_data_explorer():
     task = st.selectbox('How much data do you want to look at?', ['Counties', 'State', 'National'], 0)
-    state, counties, name, df = None, None, None, None
+    state, counties, name, dataset = None, None, None, None
     if task == 'Counties':
         state = st.selectbox("Select a state", STATES).strip()
-        county_df = queries.all_counties_query()
-        county_df = county_df[county_df['state_name'] == state]
-        county_list = county_df['county_name'].to_list()
-        county_list.sort()
+        geo = geo_index.get_geo_index()
+        county_list = geo.county_names(state)
         counties = st.multiselect('Please specify one or more counties', county_list)
         # counties = [_.strip().lower() for _ in counties]
         if len(counties) > 0:
-            county_ids = county_df.query(f'county_name in {counties}')['county_id'].to_list()
-            df = queries.get_county_data(state, county_ids)
+            dataset = datasets.CountyDataSet(state, geo.county_ids(state, counties))
             name = f"{state}_county_data"
     elif task == 'State':
         state = st.selectbox("Select a state", STATES).strip()
-        df = queries.get_county_data(state)
+        dataset = datasets.CountyDataSet(state)
         name = f"{state}_data"
     elif task == 'National':
         st.info('National analysis can take some time and be difficult to visualize at the moment.')
-        df = queries.get_national_county_data()
+        dataset = datasets.CountyDataSet()
         name = "national_data"
 
-    if df is not None:
+    if dataset is not None:
+        # Features are only loaded once a chart, map or export below asks for them
+        format_columns = FORMAT_COLUMNS.get(st.session_state.data_format, [])
         if st.checkbox('Show raw data'):
             st.subheader('Raw Data')
-            tmp_df = df.copy()
+            tmp_df = dataset.frame().set_index(['State', 'County Name'])
             st.caption(str(tmp_df.shape))
             st.dataframe(tmp_df)
-            st.download_button('Download raw data', utils.to_excel(df), file_name=f'{name}.xlsx')
+            st.download_button('Download raw data', utils.to_excel(tmp_df), file_name=f'{name}.xlsx')
 
         st.write('''### View Feature''')
-        temp = df.copy()
-        temp.reset_index(inplace=True)
         feature_labels = list(
-            set(temp.columns) - {'County Name', 'State', 'county_id', 'state_id', 'pop10_sqmi', 'pop2010','fips','cnty_fips','state_fips'})
+            set(dataset.features) - {'County Name', 'State', 'county_id', 'state_id', 'pop10_sqmi', 'pop2010','fips','cnty_fips','state_fips'})
         feature_labels.sort()
         single_feature = st.selectbox('Feature', feature_labels, 0)
 
+        temp = dataset.frame([single_feature] + format_columns)
         visualization.make_chart(temp, single_feature, st.session_state.data_format)
         counties = temp['County Name'].to_list()
         if task != 'National':
-            geo_df = queries.get_county_geoms(counties, state)
+            geo_df = queries.get_county_geoms(counties, state, coordinates=True)
             visualization.make_map(geo_df, temp, single_feature, st.session_state.data_format)
         else:
             county_ids = temp['county_id'].to_list()
-            geo_df = queries.get_county_geoms_by_id(county_ids)
+            geo_df = queries.get_county_geoms_by_id(county_ids, coordinates=True)
             visualization.make_map(geo_df, temp, single_feature, st.session_state.data_format)
         st.write('''
             ### Compare Features
@@ -67,16 +72,15 @@ def county_data_explorer():
         with col3:
             scaling_feature = st.selectbox('Scaling Feature', feature_labels, len(feature_labels) - 1)
         if feature_1 and feature_2 and scaling_feature:
+            temp = dataset.frame([feature_1, feature_2, scaling_feature] + format_columns)
             visualization.make_scatter_plot_counties(temp, feature_1, feature_2, scaling_feature, st.session_state.data_format)
-        temp.drop(['State', 'County Name', 'county_id'], inplace=True, axis=1)
-        visualization.make_correlation_plot(temp, feature_labels)
+        visualization.make_correlation_plot(None, feature_labels, dataset.cache_key(),
+                                            lambda columns: dataset.frame(columns)[columns])
 
 
 def census_data_explorer():
     state = st.selectbox("Select a state", STATES).strip()
-    county_list = queries.all_counties_query()
-    county_list = county_list[county_list['state_name'] == state]['county_name'].to_list()
-    county_list.sort()
+    county_list = geo_index.get_geo_index().county_names(state)
     counties = st.multiselect('Please a county', ['All'] + county_list)
     tables = st.multiselect('Please specify one or more datasets to view', queries.CENSUS_TABLES)
     tables = [_.strip().lower() for _ in tables]
@@ -84,9 +88,8 @@ def census_data_explorer():
 
     if len(tables) > 0 and len(counties) > 0:
         if 'All' in counties:
-            df = queries.latest_data_census_tracts(state, county_list, tables)
-        else:
-            df = queries.latest_data_census_tracts(state, counties, tables)
+            counties = county_list
+        df = queries.latest_data_census_tracts(state, counties, tables)
 
         if st.checkbox('Show raw data'):
             st.subheader('Raw Data')
@@ -138,4 +141,5 @@ def census_data_explorer():
         for col in df.columns:
             display_columns.append(col)
         display_columns.sort()
-        visualization.make_correlation_plot(df, display_columns)
+        key = cache.dataset_key('census', (state, counties, tables), queries.CENSUS_TRACT_BASE_TABLES + tables)
+        visualization.make_correlation_plot(df, display_columns, key, lambda columns: df[columns])
@@ -1,5 +1,47 @@
 import pandas as pd
 import api
+import cache
+import geo_index
+import queries
+import snapshot
+from constants import STATES
+
+DEMOGRAPHICS_TABLE = 'county_demographics'
+CHMURA_TABLE = 'chmura_economic_vulnerability_index'
+
+NON_WHITE_COLUMNS = ['black', 'ameri_es', 'asian', 'hawn_pi', 'hispanic', 'other', 'mult_race']
+AGE_19_OR_UNDER_COLUMNS = ['age_under5', 'age_5_9', 'age_10_14', 'age_15_19']
+AGE_65_OR_OVER_COLUMNS = ['age_65_74', 'age_75_84', 'age_85_up']
+
+
+def _total(df: pd.DataFrame, columns: list) -> pd.Series:
+    # Missing values propagate, as with the `+` chains in queries.county_data_columns
+    return df[columns].sum(axis=1, min_count=len(columns))
+
+
+# Features computed from county_demographics columns: label -> (source columns, function of those columns)
+DERIVED_FEATURES = {
+    'Non-White Population': (NON_WHITE_COLUMNS, lambda df: _total(df, NON_WHITE_COLUMNS)),
+    'Age 19 or Under': (AGE_19_OR_UNDER_COLUMNS, lambda df: _total(df, AGE_19_OR_UNDER_COLUMNS)),
+    'Age 65 or Over': (AGE_65_OR_OVER_COLUMNS, lambda df: _total(df, AGE_65_OR_OVER_COLUMNS)),
+    'Non-White Population (%)': (NON_WHITE_COLUMNS + ['population'],
+                                 lambda df: _total(df, NON_WHITE_COLUMNS) / df['population'] * 100),
+}
+
+BASE_COLUMNS = ['county_id', 'state_name', 'county_name']
+
+
+def county_catalog() -> dict:
+    # Every stored county feature: label -> (table, column). Only column names are read.
+    if snapshot.has_tables(DEMOGRAPHICS_TABLE):
+        demographics = snapshot.table_columns(DEMOGRAPHICS_TABLE)
+    else:
+        demographics = queries.table_columns_query([DEMOGRAPHICS_TABLE])[DEMOGRAPHICS_TABLE]
+    catalog = {queries.COUNTY_DEMOGRAPHIC_LABELS.get(c, c): (DEMOGRAPHICS_TABLE, c)
+               for c in demographics if c not in BASE_COLUMNS}
+    catalog.update({table: (queries.FRED_LATEST_TABLE, table) for table in queries.FRED_TABLES})
+    catalog['VulnerabilityIndex'] = (CHMURA_TABLE, 'VulnerabilityIndex')
+    return catalog
 
 
 class DataSet(object):
@@ -62,3 +104,85 @@ class DataSet(object):
             self.data.to_json(save_file)
         elif self.data_format == 'csv':
             self.data.to_csv(save_file)
+
+
+class CountyDataSet(object):
+    # County features for a list of counties, a state, or the whole country. Only the county names are read
+    # up front; features (stored or derived) are fetched column by column the first time they're asked for.
+    def __init__(self, state: str = None, county_ids: list = None):
+        if county_ids:
+            self.county_ids = list(county_ids)
+        elif state:
+            self.county_ids = geo_index.get_geo_index().state_county_ids(state)
+        else:
+            self.county_ids = None
+        self.catalog = county_catalog()
+
+        base = queries.county_columns_query(DEMOGRAPHICS_TABLE, BASE_COLUMNS[1:], self.county_ids)
+        if self.county_ids is None:
+            base = base[base['state_name'].isin(STATES)]
+        # The counties queries.get_all_county_data keeps: its inner join drops those with neither FRED nor
+        # COVID vulnerability data
+        present = pd.concat([queries.county_column_query(table, None, self.county_ids)['county_id']
+                             for table in (queries.FRED_LATEST_TABLE, CHMURA_TABLE)])
+        base = base[base['county_id'].isin(present)]
+        self.base = base.set_index('county_id')
+        self._sources = {}
+        self._features = {}
+
+    @property
+    def features(self) -> list:
+        return sorted(set(self.catalog) | set(DERIVED_FEATURES))
+
+    def cache_key(self) -> str:
+        # Identifies the counties and the table versions they were read at, for caches built on top of the
+        # dataset (e.g. correlation.correlation_matrix)
+        tables = {table for table, _ in self.catalog.values()} | set(queries.FRED_SOURCE_TABLES)
+        return cache.dataset_key('county', (self.county_ids,), list(tables))
+
+    def _load_sources(self, sources: list):
+        # Fetches the (table, column) pairs not loaded yet, one query per table
+        missing = [source for source in dict.fromkeys(sources) if source not in self._sources]
+        tables = {}
+        for table, column in missing:
+            tables.setdefault(table, []).append(column)
+        for table, columns in tables.items():
+            df = queries.county_columns_query(table, columns, self.county_ids).set_index('county_id')
+            df = df.reindex(self.base.index)
+            for column in columns:
+                self._sources[(table, column)] = df[column]
+
+    def column(self, label: str) -> pd.Series:
+        if label not in self._features:
+            self.load([label])
+        return self._features[label]
+
+    def load(self, labels: list):
+        labels = [label for label in labels if label not in self._features]
+        sources = []
+        for label in labels:
+            if label in DERIVED_FEATURES:
+                sources += [(DEMOGRAPHICS_TABLE, c) for c in DERIVED_FEATURES[label][0]]
+            else:
+                sources.append(self.catalog[label])
+        self._load_sources(sources)
+
+        for label in labels:
+            if label in DERIVED_FEATURES:
+                columns, func = DERIVED_FEATURES[label]
+                values = func(pd.DataFrame({c: self._sources[(DEMOGRAPHICS_TABLE, c)] for c in columns}))
+            else:
+                values = self._sources[self.catalog[label]]
+            # Matches the fillna(0) applied to the eagerly loaded county frames
+            if pd.api.types.is_numeric_dtype(values):
+                values = values.fillna(0)
+            self._features[label] = values.rename(label)
+
+    def frame(self, labels: list = None) -> pd.DataFrame:
+        # One row per county with State, County Name and county_id columns plus the requested features
+        # (every feature when labels is None)
+        labels = list(dict.fromkeys(self.features if labels is None else labels))
+        self.load(labels)
+        df = pd.concat([self.base.rename(columns={'state_name': 'State', 'county_name': 'County Name'})] +
+                       [self._features[label] for label in labels], axis=1)
+        return df.reset_index()
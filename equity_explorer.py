@@ -1,6 +1,7 @@
 import pandas as pd
 import streamlit as st
 
+import geo_index
 import queries
 import utils
 import visualization
@@ -19,9 +20,7 @@ def census_equity_explorer():
     col1, col2 = st.columns((1 + indent, 1))
     with col1:
         state = st.selectbox("Select a state", STATES).strip()
-        county_list = queries.all_counties_query()
-        county_list = county_list[county_list['state_name'] == state]['county_name'].to_list()
-        county_list.sort()
+        county_list = geo_index.get_geo_index().county_names(state)
         counties = st.multiselect('Select a county', ['All'] + county_list)
         tables = queries.EQUITY_CENSUS_TABLES
         tables = [_.strip().lower() for _ in tables]
@@ -0,0 +1,97 @@
+import os
+import sys
+import time
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
+
+ETL_WORKERS = int(os.environ.get('ETL_WORKERS', os.cpu_count() or 1))
+# Connection pool size of each worker process. A refresh holds up to ETL_WORKERS times this many loading
+# connections, plus as many again for each job that starts its own workers (e.g. spatial_join.map_transit).
+WORKER_POOL_CONNECTIONS = int(os.environ.get('ETL_WORKER_POOL', 2))
+
+
+def spawn_context():
+    # Workers are spawned rather than forked: a forked child shares the parent's open database sockets
+    return multiprocessing.get_context('spawn')
+
+
+def init_worker():
+    import queries
+    queries.set_pool_size(WORKER_POOL_CONNECTIONS)
+
+# `func` must be a module-level function so it can be sent to a worker process
+Job = namedtuple('Job', ['name', 'func', 'args', 'requires'], defaults=[(), ()])
+
+
+def check_graph(jobs: list):
+    names = [job.name for job in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError('Job names must be unique')
+    requires = {job.name: set(job.requires) for job in jobs}
+    for name, deps in requires.items():
+        unknown = deps - set(names)
+        if unknown:
+            raise ValueError(f'{name} requires unknown jobs: {", ".join(sorted(unknown))}')
+    # Kahn's algorithm; anything left over is part of a cycle
+    done = set()
+    while len(done) < len(names):
+        ready = [name for name in names if name not in done and requires[name] <= done]
+        if not ready:
+            raise ValueError(f'Dependency cycle between: {", ".join(n for n in names if n not in done)}')
+        done.update(ready)
+
+
+def _run_job(name: str, func, args: tuple) -> dict:
+    start = time.perf_counter()
+    result = {'job': name, 'pid': os.getpid(), 'status': 'done', 'error': None}
+    try:
+        func(*args)
+    except Exception as e:
+        result.update(status='failed', error=f'{type(e).__name__}: {e}')
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def run_jobs(jobs: list, workers: int = None) -> pd.DataFrame:
+    # Runs each job in a worker process as soon as the jobs it requires have finished. Jobs depending on a
+    # failed job are skipped. Returns one row of timings per job.
+    check_graph(jobs)
+    pending = {job.name: job for job in jobs}
+    done, results, running = set(), [], {}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers or ETL_WORKERS, mp_context=spawn_context(),
+                             initializer=init_worker) as executor:
+        while pending or running:
+            for job in [job for job in pending.values() if set(job.requires) <= done]:
+                print(f'Starting {job.name}')
+                running[executor.submit(_run_job, job.name, job.func, tuple(job.args))] = job.name
+                del pending[job.name]
+
+            if not running:
+                for job in pending.values():
+                    results.append({'job': job.name, 'pid': None, 'status': 'skipped', 'seconds': 0.0,
+                                    'error': 'a required job failed'})
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                del running[future]
+                result = future.result()
+                result['finished'] = round(time.perf_counter() - start, 3)
+                results.append(result)
+                print(f"{result['job']} {result['status']} in {result['seconds']:.1f}s"
+                      + (f": {result['error']}" if result['error'] else ''))
+                if result['status'] == 'done':
+                    done.add(result['job'])
+
+    report = pd.DataFrame(results, columns=['job', 'status', 'seconds', 'finished', 'pid', 'error'])
+    print(f'ETL finished in {time.perf_counter() - start:.1f}s')
+    print(report[['job', 'status', 'seconds', 'finished']].to_string(index=False))
+    return report
+
+
+if __name__ == '__main__':
+    import scripts
+    run_jobs(scripts.refresh_jobs(incremental='--incremental' in sys.argv))
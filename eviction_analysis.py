@@ -2,6 +2,7 @@ import pandas as pd
 import streamlit as st
 
 import analysis
+import geo_index
 import queries
 import utils
 import visualization
@@ -46,7 +47,11 @@ def eviction_UI():
             county = res[0].strip()
             state = res[1].strip()
             if county and state:
-                df = queries.get_county_data(state, [county])
+                county_ids = geo_index.get_geo_index().county_ids(state, [county])
+                if not county_ids:
+                    st.error(f'County not found: {county}, {state}')
+                    st.stop()
+                df = queries.get_county_data(state, county_ids)
                 if st.checkbox('Show raw data'):
                     st.subheader('Raw Data')
                     st.dataframe(df)
@@ -79,12 +84,10 @@ def eviction_UI():
 
     elif task == 'Multiple Counties':
         state = st.selectbox("Select a state", STATES).strip()
-        county_list = queries.all_counties_query()
-        county_list = county_list[county_list['state_name'] == state]['county_name'].to_list()
+        county_list = geo_index.get_geo_index().county_names(state)
         counties = st.multiselect('Please specify one or more counties', county_list)
-        counties = [_.strip().lower() for _ in counties]
         if len(counties) > 0:
-            df = queries.get_county_data(state, counties)
+            df = queries.get_county_data(state, geo_index.get_geo_index().county_ids(state, counties))
 
             if st.checkbox('Show raw data'):
                 st.subheader('Raw Data')
@@ -156,11 +159,7 @@ def eviction_UI():
             st.write(
                 "There are some counties that don't show up in this analysis because of how they are named or because data is missing. We are aware of this issue.")
 
-        frames = []
-        for state in STATES:
-            df = queries.get_county_data(state)
-            frames.append(df)
-        natl_df = pd.concat(frames)
+        natl_df = queries.get_national_county_data()
         if st.checkbox('Show raw data'):
             st.subheader('Raw Data')
             st.dataframe(natl_df)
@@ -196,13 +195,10 @@ def eviction_visualizations(df: pd.DataFrame, state: str = None):
         temp.reset_index(inplace=True)
         counties = temp['County Name'].to_list()
         if state.lower() != 'national':
-            geo_df = queries.get_county_geoms(counties, state)
+            geo_df = queries.get_county_geoms(counties, state, coordinates=True)
             visualization.make_map(geo_df, temp, 'Relative Risk')
         else:
-            frames = []
-            for s in STATES:
-                frames.append(queries.get_county_geoms(counties, s))
-            geo_df = pd.concat(frames)
+            geo_df = queries.get_county_geoms_by_id(temp['county_id'].to_list(), coordinates=True)
             visualization.make_map(geo_df, temp, 'Relative Risk')
 
 
@@ -0,0 +1,88 @@
+import threading
+import numpy as np
+import pandas as pd
+
+import cache
+
+_index = None
+_index_version = None
+_index_lock = threading.Lock()
+
+
+def _key(name: str) -> str:
+    return str(name).strip().lower()
+
+
+class GeoIndex(object):
+    # In-memory view of id_index: integer-coded states and counties, name to ID maps and county to tract arrays.
+    # Built once per id_index version so dropdowns and name lookups never go back to the database.
+    def __init__(self, df: pd.DataFrame):
+        # Integer ID columns holding NULLs arrive as float64; ids like 1001.0 would be rejected by id_array
+        df = df.dropna(subset=['county_id']).astype({'county_id': 'int64'})
+        counties = df[['state_name', 'county_name', 'county_id']].drop_duplicates('county_id')
+        counties = counties.sort_values(['state_name', 'county_name'], ignore_index=True)
+
+        state_codes = pd.Categorical(counties['state_name'])
+        self.states = list(state_codes.categories)
+        self.counties = counties.assign(state_code=state_codes.codes.astype(np.int16),
+                                        county_code=np.arange(len(counties), dtype=np.int32))
+
+        self._state_codes = {_key(s): i for i, s in enumerate(self.states)}
+        self._county_names = [[] for _ in self.states]
+        self._state_county_ids = [[] for _ in self.states]
+        self._county_ids = {}
+        self._name_county_ids = {}
+        for state_code, county_name, county_id in zip(self.counties['state_code'], self.counties['county_name'],
+                                                      self.counties['county_id']):
+            self._county_names[state_code].append(county_name)
+            self._state_county_ids[state_code].append(county_id)
+            self._county_ids[(state_code, _key(county_name))] = county_id
+            self._name_county_ids.setdefault(_key(county_name), []).append(county_id)
+
+        tracts = df[['county_id', 'tract_id']].dropna().astype('int64')
+        self._county_tracts = {county_id: group.to_numpy()
+                               for county_id, group in tracts.groupby('county_id', sort=False)['tract_id']}
+
+    def state_code(self, state: str) -> int:
+        return self._state_codes.get(_key(state))
+
+    def county_names(self, state: str) -> list:
+        state_code = self.state_code(state)
+        return list(self._county_names[state_code]) if state_code is not None else []
+
+    def state_county_ids(self, state: str) -> list:
+        state_code = self.state_code(state)
+        return list(self._state_county_ids[state_code]) if state_code is not None else []
+
+    def county_id(self, state: str, county: str):
+        return self._county_ids.get((self.state_code(state), _key(county)))
+
+    def county_ids(self, state: str, counties: list) -> list:
+        # Unknown names are skipped
+        state_code = self.state_code(state)
+        ids = [self._county_ids.get((state_code, _key(county))) for county in counties]
+        return [county_id for county_id in ids if county_id is not None]
+
+    def county_ids_by_name(self, counties: list) -> list:
+        # IDs of every county with one of these names, in any state
+        return [county_id for county in counties for county_id in self._name_county_ids.get(_key(county), [])]
+
+    def tract_ids(self, county_ids: list) -> np.ndarray:
+        arrays = [self._county_tracts[county_id] for county_id in county_ids if county_id in self._county_tracts]
+        return np.concatenate(arrays) if arrays else np.array([])
+
+    def counties_frame(self) -> pd.DataFrame:
+        return self.counties[['county_name', 'state_name', 'county_id']].copy()
+
+
+def get_geo_index() -> GeoIndex:
+    global _index, _index_version
+    import queries
+    version = cache.table_versions(['id_index'])['id_index']
+    if _index is None or version != _index_version:
+        with _index_lock:
+            if _index is None or version != _index_version:
+                df = queries.select_table('id_index', ['state_name', 'county_name', 'county_id', 'tract_id'])
+                _index = GeoIndex(df)
+                _index_version = version
+    return _index
@@ -0,0 +1,131 @@
+import os
+import sys
+import json
+import datetime
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pygeos
+
+import cache
+import snapshot
+import utils
+
+GEOMETRY_DIR = os.environ.get('GEOMETRY_STORE', 'Output/geometry')
+MANIFEST_FILE = 'manifest.json'
+
+# Level 0 is used for up to LOD_LIMITS[0] features, level 1 up to LOD_LIMITS[1], level 2 beyond that
+LOD_LIMITS = [250, 2500]
+
+# Simplification tolerances (degrees) per level; level 0 matches what the loaders used before
+GEOMETRY_LEVELS = {
+    'county_geoms': {'tolerances': [0.0001, 0.001, 0.005], 'preserve_topology': True, 'polygons': True},
+    'census_tracts_geom': {'tolerances': [0.00005, 0.0005, 0.002], 'preserve_topology': False, 'polygons': True},
+    'ntm_shapes': {'tolerances': [0.000075, 0.0005, 0.002], 'preserve_topology': False, 'polygons': False},
+}
+
+_manifest = None
+_manifest_mtime = None
+
+
+def level_for(count: int) -> int:
+    for level, limit in enumerate(LOD_LIMITS):
+        if count <= limit:
+            return level
+    return len(LOD_LIMITS)
+
+
+def render_coordinates(geoms, polygons: bool) -> list:
+    if polygons:
+        return utils.ring_coordinates_array(geoms)
+    return utils.line_paths(geoms)
+
+
+def build_geometry_store(path: str = None, tables: list = None) -> dict:
+    # Stores every level as WKB (for shapely callers) and as JSON render coordinates (for the maps), next to the
+    # table's other columns. The source table version is recorded so stale levels are never served.
+    import queries
+    path = path or GEOMETRY_DIR
+    os.makedirs(path, exist_ok=True)
+    manifest = load_manifest(path) or {'tables': {}}
+
+    for table in tables or list(GEOMETRY_LEVELS):
+        settings = GEOMETRY_LEVELS[table]
+        version = cache.table_versions([table])[table]
+        df = queries.select_table(table)
+        geoms = utils.geoms_from_wkb(df.pop('geom'))
+        for level, tolerance in enumerate(settings['tolerances']):
+            simplified = pygeos.simplify(geoms, tolerance, preserve_topology=settings['preserve_topology'])
+            df[f'wkb_{level}'] = pygeos.to_wkb(simplified)
+            df[f'coords_{level}'] = [json.dumps(c) for c in render_coordinates(simplified, settings['polygons'])]
+
+        file_name = f'{table}.parquet'
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), os.path.join(path, file_name))
+        manifest['tables'][table] = {
+            'file': file_name,
+            'rows': len(df),
+            'version': version,
+            'tolerances': settings['tolerances'],
+            'created': datetime.datetime.utcnow().isoformat(),
+        }
+        print(f'Built {len(settings["tolerances"])} levels for {table} ({len(df)} rows).')
+
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return manifest
+
+
+def load_manifest(path: str = None) -> dict:
+    global _manifest, _manifest_mtime
+    manifest_path = os.path.join(path or GEOMETRY_DIR, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    if path is not None:
+        with open(manifest_path) as f:
+            return json.load(f)
+    mtime = os.path.getmtime(manifest_path)
+    if _manifest is None or mtime != _manifest_mtime:
+        with open(manifest_path) as f:
+            _manifest = json.load(f)
+        _manifest_mtime = mtime
+    return _manifest
+
+
+def store_path(table: str) -> str:
+    # Returns None unless the store holds the table at its current version
+    manifest = load_manifest()
+    if manifest is None or table not in manifest['tables']:
+        return None
+    entry = manifest['tables'][table]
+    if entry['version'] != cache.table_versions([table])[table]:
+        return None
+    return os.path.join(GEOMETRY_DIR, entry['file'])
+
+
+def read_geometries(table: str, columns: list, where: str = None, filters: list = None, coordinates: bool = False,
+                    unique: bool = False) -> pd.DataFrame:
+    # Reads `columns` plus a `geom` column at the level of detail suited to the number of matching features.
+    # geom holds render coordinates with coordinates=True and shapely geometries otherwise. Returns None when
+    # the store can't answer the read.
+    path = store_path(table)
+    if path is None:
+        return None
+    ids = snapshot.read_parquet(path, columns[:1], where, filters)
+    if ids is None:
+        return None
+    level = level_for(len(ids))
+    geom_column = f'coords_{level}' if coordinates else f'wkb_{level}'
+    df = snapshot.read_parquet(path, columns + [geom_column], where, filters)
+    if unique:
+        df = df.drop_duplicates(subset=[geom_column], ignore_index=True)
+    if coordinates:
+        df['geom'] = df.pop(geom_column).apply(json.loads)
+    else:
+        df['geom'] = utils.to_geoseries(utils.geoms_from_wkb(df.pop(geom_column)), index=df.index)
+    return df
+
+
+if __name__ == '__main__':
+    build_geometry_store(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import uuid
+import logging
+import logging.handlers
+import datetime
+import threading
+import functools
+from collections import deque
+from contextlib import contextmanager
+import pandas as pd
+import pyarrow as pa
+import streamlit as st
+
+# Every instrumented call is appended here as one JSON object per line. Set to an empty string to disable.
+INSTRUMENTATION_LOG = os.environ.get('INSTRUMENTATION_LOG', 'Output/query_log.jsonl')
+# The log is rotated at this size, keeping INSTRUMENTATION_LOG_BACKUPS old files
+INSTRUMENTATION_LOG_BYTES = int(os.environ.get('INSTRUMENTATION_LOG_MB', 10)) * 1024 * 1024
+INSTRUMENTATION_LOG_BACKUPS = 3
+# Calls slower than this (seconds) are also logged at WARNING level
+SLOW_CALL_SECONDS = float(os.environ.get('SLOW_CALL_SECONDS', 2))
+RECENT_CALLS = 1000
+
+logger = logging.getLogger('social_data.queries')
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+_context = threading.local()
+_recent = deque(maxlen=RECENT_CALLS)
+_recent_lock = threading.Lock()
+_handler_lock = threading.Lock()
+
+
+def set_page(page: str):
+    # Called at the start of each script run; Streamlit runs every session in its own thread
+    _context.page = page
+    _context.run = uuid.uuid4().hex[:8]
+    _context.records = []
+
+
+def current_page() -> str:
+    return getattr(_context, 'page', None)
+
+
+def _stack() -> list:
+    if not hasattr(_context, 'stack'):
+        _context.stack = []
+    return _context.stack
+
+
+def _ensure_handler():
+    if logger.handlers or not INSTRUMENTATION_LOG:
+        return
+    with _handler_lock:
+        if not logger.handlers:
+            log_dir = os.path.dirname(INSTRUMENTATION_LOG)
+            if log_dir:
+                os.makedirs(log_dir, exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(INSTRUMENTATION_LOG, maxBytes=INSTRUMENTATION_LOG_BYTES,
+                                                           backupCount=INSTRUMENTATION_LOG_BACKUPS)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(handler)
+
+
+def measure(value, nbytes: int = None) -> dict:
+    # Rows and in-memory size of a result; a size already known (e.g. from the cache) skips the deep scan
+    if nbytes is not None and isinstance(value, (pd.DataFrame, pd.Series)):
+        return {'rows': len(value), 'bytes': nbytes}
+    if isinstance(value, pd.DataFrame):
+        return {'rows': len(value), 'bytes': int(value.memory_usage(index=True, deep=True).sum())}
+    if isinstance(value, pd.Series):
+        return {'rows': len(value), 'bytes': int(value.memory_usage(index=True, deep=True))}
+    if isinstance(value, pa.Table):
+        return {'rows': value.num_rows, 'bytes': value.nbytes}
+    if isinstance(value, (list, dict, tuple)):
+        return {'rows': len(value)}
+    return {}
+
+
+def add_transferred(n: int):
+    # Bytes read from the database, credited to every call on the current stack
+    for entry in _stack():
+        entry['transferred'] = entry.get('transferred', 0) + n
+
+
+def record(entry: dict):
+    entry.setdefault('page', current_page())
+    entry.setdefault('run', getattr(_context, 'run', None))
+    entry.setdefault('time', datetime.datetime.utcnow().isoformat())
+    with _recent_lock:
+        _recent.append(entry)
+    records = getattr(_context, 'records', None)
+    if records is not None:
+        records.append(entry)
+    try:
+        _ensure_handler()
+        level = logging.WARNING if entry['seconds'] >= SLOW_CALL_SECONDS else logging.INFO
+        logger.log(level, json.dumps(entry, default=str))
+    except OSError as e:
+        print(f'Could not write instrumentation log: {e}')
+
+
+@contextmanager
+def call(name: str):
+    # Times the enclosed block and records it with whatever the block adds to the yielded entry
+    stack = _stack()
+    entry = {'name': name, 'depth': len(stack)}
+    stack.append(entry)
+    start = time.perf_counter()
+    try:
+        yield entry
+    except Exception as e:
+        entry['error'] = type(e).__name__
+        raise
+    finally:
+        entry['seconds'] = round(time.perf_counter() - start, 6)
+        stack.pop()
+        record(entry)
+
+
+def timed(func):
+    name = f'{func.__module__}.{func.__qualname__}'
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with call(name) as entry:
+            value = func(*args, **kwargs)
+            entry.update(measure(value))
+            return value
+    return wrapper
+
+
+def recent_calls() -> pd.DataFrame:
+    with _recent_lock:
+        return pd.DataFrame(list(_recent))
+
+
+def diagnostics_panel():
+    # Optional sidebar panel listing the calls made while rendering the current run of the page
+    if not st.sidebar.checkbox('Show query diagnostics', False):
+        return
+    df = pd.DataFrame(getattr(_context, 'records', []))
+    with st.sidebar.expander('Query diagnostics', expanded=True):
+        if df.empty:
+            st.write('No queries were run on this rerun.')
+            return
+        for column in ['cache', 'rows', 'bytes', 'transferred']:
+            if column not in df.columns:
+                df[column] = None
+        top = df[df['depth'] == 0]
+        hits = df['cache'].isin(['memory', 'disk']).sum()
+        misses = (df['cache'] == 'miss').sum()
+        st.write(f"{len(top)} calls in {top['seconds'].sum():.2f}s, {hits} cache hits, {misses} misses, "
+                 f"{df.loc[df['depth'] == 0, 'transferred'].fillna(0).sum() / 1e6:.1f} MB from the database")
+        st.dataframe(df[['name', 'cache', 'seconds', 'rows', 'bytes', 'transferred', 'depth']].sort_values(
+            'seconds', ascending=False))
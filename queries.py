@@ -1,15 +1,32 @@
+import io
 import os
+import json
 import sys
+import time
+import uuid
+import threading
+from contextlib import contextmanager
 import psycopg2
+import psycopg2.errors
+from psycopg2 import pool as pg_pool
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pa_csv
 import fiona
 import geopandas as gpd
 from sqlalchemy import create_engine
-from shapely import wkb
+from sqlalchemy.engine import URL
+import pygeos
 import streamlit as st
 from sklearn import preprocessing
 
+import cache
 import credentials
+import geo_index
+import geometry
+import instrumentation
+import snapshot
+import utils
 from constants import STATES
 
 FRED_TABLES = [
@@ -23,6 +40,14 @@ FRED_TABLES = [
     'unemployment_rate',
 ]
 
+# Wide table holding the latest value of every FRED table per county, rebuilt by refresh_fred_latest()
+FRED_LATEST_TABLE = 'fred_latest'
+
+# Tables behind fred_query, used to key cached results
+FRED_SOURCE_TABLES = [FRED_LATEST_TABLE, 'chmura_economic_vulnerability_index'] + [
+    f'{table_name}_new' for table_name in FRED_TABLES]
+COUNTY_DATA_TABLES = ['county_demographics', 'id_index'] + FRED_SOURCE_TABLES
+
 STATIC_TABLES = [
     'chmura_economic_vulnerability_index',
     'fair_market_rents'
@@ -35,6 +60,26 @@ STATIC_COLUMNS = {
     'median_rents': ['rent50_0', 'rent50_1', 'rent50_2', 'rent50_3', 'rent50_4']
 }
 
+COUNTY_DEMOGRAPHIC_LABELS = {
+    'state_name': 'State',
+    'county_name': 'County Name',
+    'hse_units': 'Housing Units',
+    'vacant': 'Vacant Units',
+    'renter_occ': 'Renter Occupied Units',
+    'med_age': 'Median Age',
+    'white': 'White Population',
+    'black': 'Black Population',
+    'ameri_es': 'Native American Population',
+    'asian': 'Asian Population',
+    'hawn_pi': 'Pacific Islander Population',
+    'hispanic': 'Hispanic Population',
+    'other': 'Other Population',
+    'mult_race': 'Multiple Race Population',
+    'males': 'Male Population',
+    'females': 'Female Population',
+    'population': 'Total Population',
+}
+
 TABLE_HEADERS = {
     'burdened_households': 'Burdened Households',
     'homeownership_rate': 'Home Ownership',
@@ -187,64 +232,484 @@ CLIMATE_CENSUS_TABLES = [
     'national_risk_index'
 ]
 
+# Read by latest_data_census_tracts on top of the selected census tables
+CENSUS_TRACT_BASE_TABLES = ['id_index', 'census_tracts_geom', 'resident_population_census_tract']
+
+
+# Connection pool settings, shared by the psycopg2 pool and the SQLAlchemy engine. Only the minimum is opened
+# up front; connections opened under load stay pooled (see KeepAlivePool).
+POOL_MAX_CONNECTIONS = int(os.environ.get('DB_POOL_MAX', 10))
+POOL_MIN_CONNECTIONS = min(int(os.environ.get('DB_POOL_MIN', 1)), POOL_MAX_CONNECTIONS)
+POOL_CHECKOUT_TIMEOUT = 30
+# Connections idle for longer than this (seconds) are pinged before being handed out
+POOL_PING_AFTER = 60
+
+_pool = None
+_engine = None
+_pool_pid = os.getpid()
+_pool_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(POOL_MAX_CONNECTIONS)
+_last_used = {}
+# Pools inherited across a fork. They are never used or closed: a closed psycopg2 connection sends
+# Terminate on the socket it shares with the parent, which would end the parent's sessions.
+_inherited = []
+
+
+class KeepAlivePool(pg_pool.ThreadedConnectionPool):
+    # psycopg2's pools close a returned connection once they already hold `minconn` idle ones, so concurrent
+    # sessions would reconnect on every query. Returned connections are kept up to maxconn instead.
+    def _putconn(self, conn, key=None, close=False):
+        minconn = self.minconn
+        self.minconn = self.maxconn
+        try:
+            super()._putconn(conn, key, close)
+        finally:
+            self.minconn = minconn
+
+
+def set_pool_size(max_connections: int):
+    # Used by worker processes (see etl.init_worker) before they open any connection
+    global POOL_MAX_CONNECTIONS, POOL_MIN_CONNECTIONS, _pool_slots
+    POOL_MAX_CONNECTIONS = max_connections
+    POOL_MIN_CONNECTIONS = min(POOL_MIN_CONNECTIONS, max_connections)
+    _pool_slots = threading.BoundedSemaphore(max_connections)
+
+
+def _reset_after_fork():
+    # A forked child inherits the parent's pooled sockets; sharing them would interleave both processes'
+    # traffic on one connection, so the child starts with empty pools. Worker pools in etl.py and
+    # spatial_join.py use spawn and never get here; this covers any other fork.
+    global _pool, _engine, _pool_pid, _pool_lock, _pool_slots, _last_used
+    if os.getpid() != _pool_pid:
+        _inherited.append((_pool, _engine))
+        _pool, _engine = None, None
+        _pool_lock = threading.Lock()
+        _pool_slots = threading.BoundedSemaphore(POOL_MAX_CONNECTIONS)
+        _last_used = {}
+        _pool_pid = os.getpid()
+
+
+def _connection_params() -> dict:
+    if st.secrets:
+        return dict(st.secrets["postgres"])
+    return dict(
+        user=credentials.DB_USER,
+        password=credentials.DB_PASSWORD,
+        host=credentials.DB_HOST,
+        port=credentials.DB_PORT,
+        dbname=credentials.DB_NAME
+    )
+
 
 def init_engine():
-    engine = create_engine(
-        f'postgresql://{credentials.DB_USER}:{credentials.DB_PASSWORD}@{credentials.DB_HOST}:{credentials.DB_PORT}/{credentials.DB_NAME}')
-    return engine
+    global _engine
+    _reset_after_fork()
+    if _engine is None:
+        with _pool_lock:
+            if _engine is None:
+                params = _connection_params()
+                url = URL.create('postgresql', username=params['user'], password=params['password'],
+                                 host=params['host'], port=params['port'], database=params['dbname'])
+                _engine = create_engine(url, pool_size=POOL_MAX_CONNECTIONS, max_overflow=0,
+                                        pool_timeout=POOL_CHECKOUT_TIMEOUT, pool_pre_ping=True)
+    return _engine
 
 
 def init_connection():
-    if st.secrets:
-        conn = psycopg2.connect(**st.secrets["postgres"])
-    else:
-        conn = psycopg2.connect(
-            user=credentials.DB_USER,
-            password=credentials.DB_PASSWORD,
-            host=credentials.DB_HOST,
-            port=credentials.DB_PORT,
-            dbname=credentials.DB_NAME
-        )
-    return conn
+    return psycopg2.connect(**_connection_params())
+
+
+def get_pool() -> pg_pool.ThreadedConnectionPool:
+    global _pool
+    _reset_after_fork()
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = KeepAlivePool(POOL_MIN_CONNECTIONS, POOL_MAX_CONNECTIONS, **_connection_params())
+    return _pool
+
+
+def _is_healthy(conn) -> bool:
+    if conn.closed:
+        return False
+    if time.monotonic() - _last_used.get(id(conn), 0) < POOL_PING_AFTER:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1;')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+@contextmanager
+def get_connection():
+    _reset_after_fork()
+    slots = _pool_slots
+    if not slots.acquire(timeout=POOL_CHECKOUT_TIMEOUT):
+        raise pg_pool.PoolError('Timed out waiting for a database connection')
+    db_pool = get_pool()
+    conn = None
+    try:
+        conn = db_pool.getconn()
+        if not _is_healthy(conn):
+            db_pool.putconn(conn, close=True)
+            conn = db_pool.getconn()
+        yield conn
+        conn.commit()
+    except Exception:
+        if conn is not None and not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        if conn is not None:
+            if conn.closed:
+                _last_used.pop(id(conn), None)
+            else:
+                _last_used[id(conn)] = time.monotonic()
+            db_pool.putconn(conn, close=bool(conn.closed))
+        slots.release()
+
+
+# Postgres type OIDs decoded to typed Arrow columns by copy_query; anything else is read as text
+PG_ARROW_TYPES = {
+    16: pa.bool_(),
+    20: pa.int64(),
+    21: pa.int64(),
+    23: pa.int64(),
+    700: pa.float64(),
+    701: pa.float64(),
+    1700: pa.float64(),
+    1082: pa.date32(),
+    1114: pa.timestamp('us'),
+}
+# int8, int2 and int4
+INTEGER_TYPE_OIDS = {20, 21, 23}
+COPY_BLOCK_SIZE = 1 << 26
+READ_CHUNK_SIZE = 50000
+# ID sets larger than this are loaded into a temporary table rather than sent as one array parameter
+TEMP_ID_TABLE_THRESHOLD = 5000
+# Simplification tolerances (degrees) for the map geometries
+COUNTY_TOLERANCE = 0.0001
+TRACT_TOLERANCE = 0.00005
+# Per-table version stamps used to invalidate cached results, see cache.py
+TABLE_VERSIONS = 'table_versions'
+
+
+@instrumentation.timed
+def copy_query_arrow(query: str, params: tuple = None, temp_tables: list = None) -> pa.Table:
+    # Streams the result through COPY ... TO STDOUT and decodes it column-wise with Arrow instead of
+    # building a Python tuple per row with fetchall()
+    query = query.strip().rstrip(';')
+    with get_connection() as conn:
+        cur = conn.cursor()
+        create_id_tables(cur, temp_tables or [])
+        if params is not None:
+            query = cur.mogrify(query, params).decode()
+        cur.execute(f'SELECT * FROM ({query}) AS copy_query LIMIT 0;')
+        colnames = [desc[0] for desc in cur.description]
+        type_codes = [desc[1] for desc in cur.description]
+        buffer = io.BytesIO()
+        cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, NULL '\\N')", buffer)
+    instrumentation.add_transferred(buffer.tell())
+
+    # Positional names keep duplicate column names (e.g. from table.* joins) apart while decoding
+    names = [f'c{i}' for i in range(len(colnames))]
+    column_types = {name: PG_ARROW_TYPES.get(oid, pa.string()) for name, oid in zip(names, type_codes)}
+    if buffer.tell() == 0:
+        return pa.schema([(name, column_types[name]) for name in names]).empty_table().rename_columns(colnames)
+    buffer.seek(0)
+    table = pa_csv.read_csv(
+        buffer,
+        read_options=pa_csv.ReadOptions(column_names=names, block_size=COPY_BLOCK_SIZE),
+        # COPY quotes text values containing newlines; without this Arrow splits those rows
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+        convert_options=pa_csv.ConvertOptions(column_types=column_types, null_values=['\\N'],
+                                              strings_can_be_null=True, true_values=['t'], false_values=['f'])
+    )
+    return table.rename_columns(colnames)
+
+
+def copy_query(query: str, params: tuple = None, temp_tables: list = None) -> pd.DataFrame:
+    table = copy_query_arrow(query, params, temp_tables)
+    colnames = table.column_names
+    df = table.rename_columns([f'c{i}' for i in range(len(colnames))]).to_pandas()
+    df.columns = colnames
+    return df
+
+
+def id_array(ids) -> str:
+    # Postgres array literal sent as a single parameter. It is left untyped so Postgres casts it to the
+    # filtered column's type, which lets the same call filter integer and text ID columns.
+    return '{' + ','.join('"' + str(i).replace('\\', '\\\\').replace('"', '\\"') + '"' for i in ids) + '}'
+
+
+def id_filter(column: str, ids, temp_tables: list = None) -> tuple:
+    # Returns a (condition, params) pair matching `column` against a set of IDs. When temp_tables is given,
+    # sets larger than TEMP_ID_TABLE_THRESHOLD are queued there for create_id_tables and joined instead.
+    # `column` must be qualified with its table in that case.
+    ids = list(dict.fromkeys(ids))
+    if temp_tables is not None and len(ids) > TEMP_ID_TABLE_THRESHOLD:
+        name = f'filter_ids_{len(temp_tables)}'
+        temp_tables.append((name, column, ids))
+        return f'{column} IN (SELECT id FROM {name})', ()
+    return f'{column} = ANY(%s)', (id_array(ids),)
+
+
+def create_id_tables(cur, temp_tables: list):
+    # Loads queued ID sets with COPY into temporary tables typed like the filtered column; they are dropped
+    # when get_connection commits
+    for name, column, ids in temp_tables:
+        table = column.rsplit('.', 1)[0]
+        cur.execute(f'CREATE TEMP TABLE {name} ON COMMIT DROP AS SELECT {column} AS id FROM {table} LIMIT 0;')
+        buffer = io.StringIO('\n'.join('"' + str(i).replace('"', '""') + '"' for i in ids))
+        cur.copy_expert(f'COPY {name} (id) FROM STDIN WITH (FORMAT csv)', buffer)
+        cur.execute(f'ANALYZE {name};')
+
+
+def select_table(table: str, columns: list = None, where: str = None) -> pd.DataFrame:
+    # Serves the read from the Parquet snapshot when one is enabled, otherwise from the database
+    df = snapshot.read_table(table, columns, where)
+    if df is None:
+        cols = ', '.join('"{}"'.format(c) for c in columns) if columns else '*'
+        query = f'SELECT {cols} FROM {table}'
+        if where is not None:
+            query += f' WHERE {where}'
+        df = copy_query(query)
+    return df
 
 
-def write_table(df: pd.DataFrame, table: str):
-    engine = init_engine()
-    df.to_sql(table, engine, if_exists='replace', method='multi')
+def select_ids(table: str, column: str, ids: list, columns: list = None) -> pd.DataFrame:
+    # Rows of `table` whose `column` is one of ids, from the snapshot when one is enabled
+    df = snapshot.read_table(table, columns, filters=[(column, 'in', list(ids))])
+    if df is None:
+        cols = ', '.join('"{}"'.format(c) for c in columns) if columns else '*'
+        temp_tables = []
+        condition, params = id_filter(f'{table}.{column}', ids, temp_tables)
+        df = copy_query(f'SELECT {cols} FROM {table} WHERE {condition};', params, temp_tables)
+    return df
+
+
+@instrumentation.timed
+def write_table(df: pd.DataFrame, table: str, index: bool = True) -> int:
+    chunks = (df.iloc[i:i + READ_CHUNK_SIZE] for i in range(0, max(len(df), 1), READ_CHUNK_SIZE))
+    return write_table_chunks(chunks, table, index)
+
+
+def copy_chunk(cur, table: str, df: pd.DataFrame, integer_columns: list):
+    # Integer columns of the staging table can arrive as floats in later chunks when they hold NULLs, which
+    # COPY would reject as "1.0"
+    for column in integer_columns:
+        if not pd.api.types.is_integer_dtype(df[column]):
+            df[column] = df[column].astype('Int64')
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False, na_rep='\\N')
+    instrumentation.add_transferred(buffer.tell())
+    buffer.seek(0)
+    columns = ', '.join('"{}"'.format(c) for c in df.columns)
+    cur.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+
+
+def coerce_chunk(df: pd.DataFrame, dtypes: pd.Series) -> pd.DataFrame:
+    # Casts a chunk column by column to the dtypes of the first chunk, which the staging table was created
+    # from. Values that don't fit (decimals in an integer column, text in a numeric one) raise rather than load.
+    for column, dtype in dtypes.items():
+        if column not in df.columns or df[column].dtype == dtype:
+            continue
+        series = df[column]
+        if pd.api.types.is_bool_dtype(dtype):
+            continue
+        if pd.api.types.is_integer_dtype(dtype):
+            numbers = pd.to_numeric(series)
+            if not (numbers.dropna() % 1 == 0).all():
+                raise ValueError(f'{column} was created as an integer column but a later chunk holds decimals; '
+                                 'pass explicit dtypes')
+            df[column] = numbers.astype('Int64')
+        elif pd.api.types.is_float_dtype(dtype):
+            df[column] = pd.to_numeric(series).astype(dtype)
+        else:
+            df[column] = series.where(series.isna(), series.astype(str))
+    return df
+
+
+@instrumentation.timed
+def write_table_chunks(chunks, table: str, index: bool = False, geometry_columns: list = None) -> int:
+    # Streams the chunks with COPY into a staging table created from the first chunk's schema, then swaps it
+    # in within the same transaction, so readers see either the old or the new table and never a partial one.
+    # Frames produced by read_table_chunks can be transformed and written without holding the whole table.
+    # geometry_columns hold (E)WKB hex text and are converted to PostGIS geometries before the swap.
+    # When the table already exists with the same columns, the staging table copies its definition, indexes
+    # and constraints, and its grants are reapplied after the swap. Views or foreign keys depending on the
+    # table make the DROP fail; that error is raised rather than cascaded.
+    staging = f'{table}_staging'
+    rows = 0
+    integer_columns = None
+    dtypes = None
+    with get_connection() as conn:
+        cur = conn.cursor()
+        for df in chunks:
+            df = df.reset_index() if index else df.copy()
+            if dtypes is None:
+                dtypes = df.dtypes
+            else:
+                df = coerce_chunk(df, dtypes)
+            if integer_columns is None:
+                cur.execute(f'DROP TABLE IF EXISTS {staging};')
+                cur.execute("""SELECT column_name FROM information_schema.columns
+                    WHERE table_schema = 'public' AND table_name = %s;""", (table,))
+                existing = {row[0] for row in cur.fetchall()}
+                if existing and existing == set(map(str, df.columns)):
+                    cur.execute(f'CREATE TABLE {staging} (LIKE {table} INCLUDING ALL);')
+                    cur.execute(f'SELECT * FROM {staging} LIMIT 0;')
+                    integer_columns = [desc[0] for desc in cur.description if desc[1] in INTEGER_TYPE_OIDS]
+                    geometry_columns = []
+                else:
+                    if existing:
+                        print(f'{table}: columns changed, its indexes and constraints are not carried over')
+                    cur.execute(pd.io.sql.get_schema(df, staging, con=init_engine()))
+                    integer_columns = [c for c in df.columns if pd.api.types.is_integer_dtype(df[c])]
+            copy_chunk(cur, staging, df, integer_columns)
+            rows += len(df)
+        if integer_columns is None:
+            return rows
+        for column in geometry_columns or []:
+            cur.execute(f'ALTER TABLE {staging} ALTER COLUMN "{column}" TYPE geometry USING "{column}"::geometry;')
+        cur.execute("""SELECT grantee, privilege_type FROM information_schema.role_table_grants
+            WHERE table_schema = 'public' AND table_name = %s AND grantee <> current_user;""", (table,))
+        grants = cur.fetchall()
+        cur.execute(f'DROP TABLE IF EXISTS {table};')
+        cur.execute(f'ALTER TABLE {staging} RENAME TO {table};')
+        for grantee, privilege in grants:
+            grantee = grantee if grantee == 'PUBLIC' else '"{}"'.format(grantee)
+            cur.execute(f'GRANT {privilege} ON {table} TO {grantee};')
+    bump_table_versions([table])
+    return rows
+
+
+@instrumentation.timed
+def upsert_table_chunks(chunks, table: str, keys: list) -> dict:
+    # Loads the chunks into a temporary table, then updates rows whose values changed and inserts rows with
+    # new keys. Rows missing from the chunks are left alone. Rows with a NULL key are skipped, and when a key
+    # appears more than once in the chunks the last row wins. Falls back to a full load when the table doesn't
+    # exist yet. Returns the number of incoming, inserted, updated and skipped rows.
+    if table not in table_names_query():
+        rows = write_table_chunks(chunks, table)
+        return {'incoming': rows, 'inserted': rows, 'updated': 0, 'skipped': 0}
+
+    incoming = f'{table}_incoming'
+    key_names = ', '.join('"{}"'.format(k) for k in keys)
+    counts = {'incoming': 0, 'inserted': 0, 'updated': 0, 'skipped': 0}
+    columns = None
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f'CREATE INDEX IF NOT EXISTS {table}_upsert_keys ON {table} ({key_names});')
+        cur.execute(f'CREATE TEMP TABLE {incoming} (LIKE {table}) ON COMMIT DROP;')
+        cur.execute(f'SELECT * FROM {incoming} LIMIT 0;')
+        integer_columns = [desc[0] for desc in cur.description if desc[1] in INTEGER_TYPE_OIDS]
+        # Filled in load order by COPY, so duplicates can be resolved deterministically
+        cur.execute(f'ALTER TABLE {incoming} ADD COLUMN upsert_row bigserial;')
+        dtypes = None
+        for df in chunks:
+            columns = list(df.columns) if columns is None else columns
+            df = df[columns].copy()
+            dtypes = df.dtypes if dtypes is None else dtypes
+            copy_chunk(cur, incoming, coerce_chunk(df, dtypes), [c for c in integer_columns if c in columns])
+            counts['incoming'] += len(df)
+        if columns is None:
+            return counts
+        null_keys = ' OR '.join(f'"{k}" IS NULL' for k in keys)
+        cur.execute(f'DELETE FROM {incoming} WHERE {null_keys};')
+        counts['skipped'] += cur.rowcount
+        cur.execute(f"""DELETE FROM {incoming} WHERE upsert_row IN (
+            SELECT upsert_row FROM (
+                SELECT upsert_row, row_number() OVER (PARTITION BY {key_names} ORDER BY upsert_row DESC) AS n
+                FROM {incoming}) ranked
+            WHERE n > 1);""")
+        counts['skipped'] += cur.rowcount
+        cur.execute(f'ANALYZE {incoming};')
+
+        values = [c for c in columns if c not in keys]
+        match = ' AND '.join(f't."{k}" = i."{k}"' for k in keys)
+        if values:
+            assignments = ', '.join(f'"{c}" = i."{c}"' for c in values)
+            target_values = ', '.join(f't."{c}"' for c in values)
+            incoming_values = ', '.join(f'i."{c}"' for c in values)
+            cur.execute(f"""UPDATE {table} t SET {assignments}
+                FROM {incoming} i
+                WHERE {match} AND ROW({target_values}) IS DISTINCT FROM ROW({incoming_values});""")
+            counts['updated'] = cur.rowcount
+        column_names = ', '.join('"{}"'.format(c) for c in columns)
+        cur.execute(f"""INSERT INTO {table} ({column_names})
+            SELECT {column_names} FROM {incoming} i
+            WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE {match});""")
+        counts['inserted'] = cur.rowcount
+    if counts['inserted'] or counts['updated']:
+        bump_table_versions([table])
+    return counts
+
+
+@instrumentation.timed
+def table_versions_query(tables: list) -> dict:
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f"SELECT table_name, version FROM {TABLE_VERSIONS} WHERE table_name = ANY(%s);",
+                        (list(tables),))
+            results = cur.fetchall()
+    except psycopg2.errors.UndefinedTable:
+        return {}
+    return dict(results)
+
+
+@instrumentation.timed
+def bump_table_versions(tables: list):
+    # Versions are microsecond timestamps so they keep increasing even if the table is recreated
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""CREATE TABLE IF NOT EXISTS {TABLE_VERSIONS} (
+            table_name text PRIMARY KEY,
+            version bigint NOT NULL);""")
+        cur.execute(f"""INSERT INTO {TABLE_VERSIONS} (table_name, version)
+            SELECT unnest(%s::text[]), (extract(epoch FROM clock_timestamp()) * 1000000)::bigint
+            ON CONFLICT (table_name) DO UPDATE SET version = excluded.version;""", (list(tables),))
+    cache.forget_versions(tables)
 
 
 def all_counties_query(where: str = None) -> pd.DataFrame:
-    conn = init_connection()
-    cur = conn.cursor()
+    if where is None:
+        return geo_index.get_geo_index().counties_frame()
+    df = snapshot.read_table('id_index', ['county_name', 'state_name', 'county_id'], where)
+    if df is not None:
+        return df.drop_duplicates(ignore_index=True)
     query = f"SELECT DISTINCT county_name, state_name, county_id FROM id_index"
     if where:
         query += f" WHERE {where}"
     query += ";"
-    cur.execute(query)
-    colnames = [desc[0] for desc in cur.description]
-    results = cur.fetchall()
-    conn.commit()
-    df = pd.DataFrame(results, columns=colnames)
+    df = copy_query(query)
     return df
 
 
+@instrumentation.timed
 def table_names_query() -> list:
-    conn = init_connection()
-    cur = conn.cursor()
-    cur.execute("""SELECT table_name FROM information_schema.tables
-        WHERE table_schema = 'public'
-        """)
-    results = cur.fetchall()
-    conn.commit()
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""SELECT table_name FROM information_schema.tables
+            WHERE table_schema = 'public'
+            """)
+        results = cur.fetchall()
 
     res = [_[0] for _ in results]
     return res
 
 
-@st.experimental_memo(ttl=1200)
+@cache.cached(tables=lambda table, *args, **kwargs: [table])
 def read_table(table: str, columns: list = None, where: str = None, order_by: str = None,
                order: str = 'ASC', fred=False) -> pd.DataFrame:
-    conn = init_connection()
+    if not fred and order_by is None:
+        df = snapshot.read_table(table, columns, where)
+        if df is not None:
+            return df
     if not fred:
         if columns is not None:
             cols = ', '.join(columns)
@@ -265,39 +730,127 @@ def read_table(table: str, columns: list = None, where: str = None, order_by: st
                       AND {table}.county_id=max_county.county_id
                       AND {table}.date=max_county.date"""
     query += ';'
-    df = pd.read_sql(query, con=conn)
+    with get_connection() as conn:
+        df = pd.read_sql(query, con=conn)
     return df
 
 
-@st.experimental_memo(ttl=1200)
-def latest_data_census_tracts(state: str, counties: list, tables: list) -> pd.DataFrame:
-    conn = init_connection()
-    cur = conn.cursor()
-    tracts_df = census_tracts_geom_query(counties, state)
-    counties_str = str(tuple(counties)).replace(',)', ')')
-    where_clause = f"WHERE id_index.state_name ='{state}' AND id_index.county_name IN {counties_str}"
+def read_query_chunks(query: str, chunksize: int = READ_CHUNK_SIZE):
+    # Named cursors are server-side, so only `chunksize` rows are held client-side at a time
+    with get_connection() as conn:
+        cur = conn.cursor(name=f'chunks_{uuid.uuid4().hex}')
+        cur.itersize = chunksize
+        cur.execute(query.strip().rstrip(';'))
+        colnames = None
+        while True:
+            results = cur.fetchmany(chunksize)
+            if colnames is None:
+                colnames = [desc[0] for desc in cur.description]
+            if not results:
+                break
+            yield pd.DataFrame(results, columns=colnames)
+        cur.close()
+
+
+def read_table_chunks(table: str, columns: list = None, where: str = None,
+                      chunksize: int = READ_CHUNK_SIZE):
+    if columns is not None:
+        cols = ', '.join(columns)
+        query = f"SELECT {cols} FROM {table}"
+    else:
+        query = f"SELECT * FROM {table}"
+    if where is not None:
+        query += f" WHERE {where}"
+    query += ';'
+    return read_query_chunks(query, chunksize)
 
-    for table_name in tables:
-        query = f"""SELECT {table_name}.*, id_index.county_name, id_index.county_id, id_index.state_name, id_index.tract_id,
-        resident_population_census_tract.tot_population_census_2010
-            FROM {table_name} 
-            INNER JOIN id_index ON {table_name}.tract_id = id_index.tract_id
-            INNER JOIN resident_population_census_tract ON {table_name}.tract_id = resident_population_census_tract.tract_id
-            {where_clause};"""
-        cur.execute(query)
+
+@cache.cached(tables=lambda tables: list(tables))
+def table_columns_query(tables: list) -> dict:
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""SELECT table_name, column_name FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = ANY(%s)
+            ORDER BY table_name, ordinal_position;""", (list(tables),))
         results = cur.fetchall()
-        conn.commit()
 
-        colnames = [desc[0] for desc in cur.description]
-        df = pd.DataFrame(results, columns=colnames)
-        df = df.loc[:, ~df.columns.duplicated()]
+    columns = {table_name: [] for table_name in tables}
+    for table_name, column_name in results:
+        columns[table_name].append(column_name)
+    return columns
+
+
+def census_tracts_columns(tables: list, table_columns: dict) -> list:
+    # Resolves which table provides each output column, as (table, column) pairs. The first table to provide
+    # a column wins, matching the old per-table merge behaviour.
+    seen = {'Census Tract', 'geom', 'tract_id'}
+    columns = []
+    for i, table_name in enumerate(tables):
+        for column in table_columns[table_name]:
+            if column not in seen:
+                columns.append((table_name, column))
+                seen.add(column)
+        if i == 0:
+            for column in ['county_name', 'county_id', 'state_name']:
+                if column not in seen:
+                    columns.append(('id_index', column))
+                    seen.add(column)
+            if 'tot_population_census_2010' not in seen:
+                columns.append(('resident_population_census_tract', 'tot_population_census_2010'))
+                seen.add('tot_population_census_2010')
+    return columns
+
+
+def census_tracts_query(tables: list, where_clause: str) -> str:
+    # Builds a single statement joining every tract table on id_index. It is run with parameters, so % signs
+    # in column names are escaped.
+    tables = list(dict.fromkeys(tables))
+    columns = census_tracts_columns(tables, table_columns_query(tables))
+    select = ['id_index.tract_id AS "Census Tract"'] + [
+        f'{table_name}."{column}"'.replace('%', '%%') for table_name, column in columns]
+    joins = ['INNER JOIN resident_population_census_tract '
+             'ON resident_population_census_tract.tract_id = id_index.tract_id']
+    for table_name in tables:
+        if table_name != 'resident_population_census_tract':
+            joins.append(f'INNER JOIN {table_name} ON {table_name}.tract_id = id_index.tract_id')
 
-        df.rename({'tract_id': 'Census Tract'}, axis=1, inplace=True)
+    select_str = ',\n            '.join(select)
+    joins_str = '\n        '.join(joins)
+    query = f"""SELECT {select_str}
+        FROM id_index
+        {joins_str}
+        {where_clause};"""
+    return query
+
+
+def census_tracts_snapshot(tables: list, county_ids: list) -> pd.DataFrame:
+    # Same result as census_tracts_query, joined in memory from the snapshot files
+    tables = list(dict.fromkeys(tables))
+    columns = census_tracts_columns(tables, {table_name: snapshot.table_columns(table_name) for table_name in tables})
+    df = snapshot.read_table('id_index', ['tract_id'] + [c for t, c in columns if t == 'id_index'],
+                             filters=[('county_id', 'in', list(county_ids))])
+    tract_ids = df['tract_id'].to_list()
+    for table_name in dict.fromkeys(['resident_population_census_tract'] + tables):
+        table_df = snapshot.read_table(table_name, ['tract_id'] + [c for t, c in columns if t == table_name],
+                                       filters=[('tract_id', 'in', tract_ids)])
+        df = df.merge(table_df, on='tract_id', how='inner')
+    df = df[['tract_id'] + [column for _, column in columns]]
+    return df.rename(columns={'tract_id': 'Census Tract'})
+
+
+@cache.cached(tables=lambda state, counties, tables: CENSUS_TRACT_BASE_TABLES + list(tables))
+def latest_data_census_tracts(state: str, counties: list, tables: list) -> pd.DataFrame:
+    tracts_df = census_tracts_geom_query(counties, state, coordinates=True)
+    county_ids = geo_index.get_geo_index().county_ids(state, counties)
+    if snapshot.has_tables('id_index', 'resident_population_census_tract', *tables):
+        df = census_tracts_snapshot(tables, county_ids)
+    else:
+        condition, params = id_filter('id_index.county_id', county_ids)
+        query = census_tracts_query(tables, f'WHERE {condition}')
+        df = copy_query(query, params)
 
-        tracts_df = tracts_df.merge(df, on="Census Tract", how="inner", suffixes=('', '_y'))
-        tracts_df.drop(tracts_df.filter(regex='_y$').columns.tolist(), axis=1, inplace=True)
-        tracts_df = tracts_df.loc[:, ~tracts_df.columns.duplicated()]
-    return tracts_df
+    tracts_df = tracts_df.merge(df, on="Census Tract", how="inner")
+    return utils.compact_dtypes(tracts_df)
 
 
 def load_distributions() -> tuple:
@@ -315,33 +868,32 @@ def load_distributions() -> tuple:
     return metro_areas, locations
 
 
+@instrumentation.timed
 def policy_query() -> pd.DataFrame:
-    conn = init_connection()
-    cur = conn.cursor()
-    cur.execute(
-        'SELECT county_id as county_id, policy_value as "Policy Value", countdown as "Countdown" '
-        'FROM policy'
-    )
-    colnames = [desc[0] for desc in cur.description]
-    results = cur.fetchall()
-    conn.commit()
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            'SELECT county_id as county_id, policy_value as "Policy Value", countdown as "Countdown" '
+            'FROM policy'
+        )
+        colnames = [desc[0] for desc in cur.description]
+        results = cur.fetchall()
 
     return pd.DataFrame(results, columns=colnames)
 
 
+@instrumentation.timed
 def latest_data_single_table(table_name: str, require_counties: bool = True) -> pd.DataFrame:
-    conn = init_connection()
-    cur = conn.cursor()
-    cur.execute(
-        'SELECT DISTINCT ON (county_id) '
-        'county_id, date AS "{} Date", value AS "{} ({})" '
-        'FROM {} '
-        'ORDER BY county_id , "date" DESC'.format(TABLE_HEADERS[table_name], TABLE_HEADERS[table_name],
-                                                  TABLE_UNITS[table_name], table_name))
-    results = cur.fetchall()
-    conn.commit()
-
-    colnames = [desc[0] for desc in cur.description]
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            'SELECT DISTINCT ON (county_id) '
+            'county_id, date AS "{} Date", value AS "{} ({})" '
+            'FROM {} '
+            'ORDER BY county_id , "date" DESC'.format(TABLE_HEADERS[table_name], TABLE_HEADERS[table_name],
+                                                      TABLE_UNITS[table_name], table_name))
+        results = cur.fetchall()
+        colnames = [desc[0] for desc in cur.description]
 
     df = pd.DataFrame(results, columns=colnames)
     if require_counties:
@@ -350,42 +902,127 @@ def latest_data_single_table(table_name: str, require_counties: bool = True) ->
     return df
 
 
-@st.experimental_memo(ttl=1200)
-def fred_query(counties_str: str) -> pd.DataFrame:
-    frames = []
-    for table_name in FRED_TABLES:
-        # Todo: update in database and remove new suffix
-        f_df = read_table(f"{table_name}_new", where=f"county_id in {counties_str}", columns=[table_name, 'county_id'],
-                          fred=True)
-        f_df.drop(['date', 'state_name', 'county_name'], axis=1, inplace=True)
-        frames.append(f_df)
-    fred_df = pd.concat(frames, axis=1)
-    fred_df = fred_df.loc[:, ~fred_df.columns.duplicated()]
-    fred_df = fred_df.astype(float)
+def latest_fred_series_query(where: str = None) -> str:
+    # Latest value of every FRED table for each county, one row per (county_id, series)
+    # Todo: update in database and remove new suffix
+    series = '\n            UNION ALL\n            '.join(
+        f"SELECT county_id, date, '{table_name}' AS series, CAST({table_name} AS text) AS value FROM {table_name}_new"
+        for table_name in FRED_TABLES)
+    query = f"""SELECT DISTINCT ON (county_id, series) county_id, series, value
+        FROM (
+            {series}
+        ) fred
+        {'WHERE ' + where if where else ''}
+        ORDER BY county_id, series, date DESC"""
+    return query
+
+
+@instrumentation.timed
+def refresh_fred_latest():
+    # Rebuilds FRED_LATEST_TABLE from the FRED _new tables and swaps it in within one transaction,
+    # so readers see either the old or the new table and never a partial one
+    staging = f'{FRED_LATEST_TABLE}_staging'
+    columns = ',\n            '.join(
+        f"CAST(NULLIF(max(value) FILTER (WHERE series = '{table_name}'), '') AS double precision) AS {table_name}"
+        for table_name in FRED_TABLES)
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f'DROP TABLE IF EXISTS {staging};')
+        cur.execute(f"""CREATE TABLE {staging} AS
+            SELECT county_id,
+            {columns}
+            FROM ({latest_fred_series_query()}) latest
+            GROUP BY county_id;""")
+        cur.execute(f'CREATE UNIQUE INDEX {staging}_county_id ON {staging} (county_id);')
+        cur.execute(f'DROP TABLE IF EXISTS {FRED_LATEST_TABLE};')
+        cur.execute(f'ALTER TABLE {staging} RENAME TO {FRED_LATEST_TABLE};')
+        cur.execute(f'ALTER INDEX {staging}_county_id RENAME TO {FRED_LATEST_TABLE}_county_id;')
+    bump_table_versions([FRED_LATEST_TABLE])
+
+
+def latest_fred_query(county_ids: list = None, series: list = None) -> pd.DataFrame:
+    # Reads the precomputed FRED_LATEST_TABLE when it exists, falling back to aggregating the FRED tables live.
+    # `series` limits the FRED columns read (all by default).
+    series = FRED_TABLES if series is None else list(series)
+    filters = [('county_id', 'in', list(county_ids))] if county_ids is not None else None
+    df = snapshot.read_table(FRED_LATEST_TABLE, ['county_id'] + series, filters=filters)
+    if df is not None:
+        return df
+    where, params = id_filter('county_id', county_ids) if county_ids is not None else (None, None)
+    columns = ', '.join(['county_id'] + series)
+    try:
+        return copy_query(f"SELECT {columns} FROM {FRED_LATEST_TABLE} {'WHERE ' + where if where else ''};",
+                          params)
+    except psycopg2.errors.UndefinedTable:
+        pass
+
+    df = copy_query(latest_fred_series_query(where), params)
+    fred_df = df.pivot(index='county_id', columns='series', values='value')
+    fred_df = fred_df.reindex(columns=series).astype(float)
+    fred_df.columns.name = None
+    return fred_df.reset_index()
+
+
+@cache.cached(tables=FRED_SOURCE_TABLES)
+def fred_query(county_ids: list = None) -> pd.DataFrame:
+    fred_df = latest_fred_query(county_ids)
     chmura_df = static_data_single_table('chmura_economic_vulnerability_index', ['VulnerabilityIndex'])
     fred_df = fred_df.merge(chmura_df, how='outer', on='county_id', suffixes=('', '_DROP')).filter(
         regex='^(?!.*_DROP)')
     return fred_df
 
 
-@st.experimental_memo(ttl=1200)
+@cache.cached(tables=COUNTY_DATA_TABLES)
 def get_all_county_data(state: str, counties: list) -> pd.DataFrame:
-    if counties:
-        counties_str = "(" + ",".join(["'" + str(_) + "'" for _ in counties]) + ")"
-        demo_df = read_table('county_demographics', where=f"county_id in {counties_str}")
-        fred_df = fred_query(counties_str)
-        demo_df = demo_df.merge(fred_df, on='county_id', how='inner', suffixes=('', '_DROP')).filter(
-            regex='^(?!.*_DROP)')
+    # `counties` are county IDs; without them every county in the state is loaded
+    county_ids = list(counties) if counties else geo_index.get_geo_index().state_county_ids(state)
+    demo_df = select_ids('county_demographics', 'county_id', county_ids)
+    fred_df = fred_query(county_ids)
+    demo_df = demo_df.merge(fred_df, on='county_id', how='inner', suffixes=('', '_DROP')).filter(
+        regex='^(?!.*_DROP)')
 
-    else:
-        demo_df = read_table('county_demographics', where=f"state_name='{state}';")
-        counties = all_counties_query(f"state_name='{state}'")
-        county_ids = counties['county_id'].to_list()
-        counties_str = "(" + ",".join(["'" + str(_) + "'" for _ in county_ids]) + ")"
-        fred_df = fred_query(counties_str=counties_str)
-        demo_df = demo_df.merge(fred_df, on='county_id', how='inner', suffixes=('', '_DROP')).filter(
-            regex='^(?!.*_DROP)')
+    # Compacted before it's cached, so the memory and disk tiers hold the small frame
+    return utils.compact_dtypes(county_data_columns(demo_df))
 
+
+def fetch_county_columns(table: str, columns: list, county_ids: list = None) -> pd.DataFrame:
+    # county_id plus `columns` of a county-level table in one query. Without county_ids every county is returned.
+    columns = list(columns)
+    if table == FRED_LATEST_TABLE:
+        df = latest_fred_query(county_ids, columns)
+    elif county_ids is None:
+        df = select_table(table, ['county_id'] + columns)
+    else:
+        df = select_ids(table, 'county_id', county_ids, ['county_id'] + columns)
+    df = df[['county_id'] + columns].dropna(subset=['county_id']).drop_duplicates('county_id', ignore_index=True)
+    return utils.compact_dtypes(df)
+
+
+@cache.cached(tables=lambda table, column, county_ids=None:
+              FRED_SOURCE_TABLES if table == FRED_LATEST_TABLE else [table])
+def county_column_query(table: str, column: str, county_ids: list = None) -> pd.DataFrame:
+    # county_id plus one column (just county_id when column is None)
+    return fetch_county_columns(table, [column] if column else [], county_ids)
+
+
+def county_columns_query(table: str, columns: list, county_ids: list = None) -> pd.DataFrame:
+    # county_id plus `columns` of one county-level table, for the lazily loaded datasets in datasets.py. Each
+    # column is cached on its own, so the charts, maps and exports asking for different combinations of
+    # features share their entries; the columns not cached yet are read together in one query.
+    if not columns:
+        return county_column_query(table, None, county_ids)
+    frames = {column: county_column_query.lookup(table, column, county_ids) for column in columns}
+    missing = [column for column, df in frames.items() if df is None]
+    if missing:
+        fetched = fetch_county_columns(table, missing, county_ids)
+        for column in missing:
+            df = fetched[['county_id', column]].copy()
+            county_column_query.store(df, table, column, county_ids)
+            frames[column] = df
+    return pd.concat([frames[column].set_index('county_id') for column in columns], axis=1).reset_index()
+
+
+def county_data_columns(demo_df: pd.DataFrame) -> pd.DataFrame:
     demo_df['Non-White Population'] = (demo_df['black'] + demo_df['ameri_es'] + demo_df['asian'] + demo_df[
         'hawn_pi'] + demo_df['hispanic'] + demo_df['other'] + demo_df['mult_race'])
     demo_df['Age 19 or Under'] = (
@@ -394,177 +1031,156 @@ def get_all_county_data(state: str, counties: list) -> pd.DataFrame:
     demo_df['Non-White Population (%)'] = demo_df['Non-White Population'] / demo_df['population'] * 100
     demo_df['fips'] = demo_df['fips'].astype(int)
 
-    demo_df.rename({
-        'state_name': 'State',
-        'county_name': 'County Name',
-        'hse_units': 'Housing Units',
-        'vacant': 'Vacant Units',
-        'renter_occ': 'Renter Occupied Units',
-        'med_age': 'Median Age',
-        'white': 'White Population',
-        'black': 'Black Population',
-        'ameri_es': 'Native American Population',
-        'asian': 'Asian Population',
-        'hawn_pi': 'Pacific Islander Population',
-        'hispanic': 'Hispanic Population',
-        'other': 'Other Population',
-        'mult_race': 'Multiple Race Population',
-        'males': 'Male Population',
-        'females': 'Female Population',
-        'population': 'Total Population',
-    }, axis=1, inplace=True)
+    demo_df.rename(COUNTY_DEMOGRAPHIC_LABELS, axis=1, inplace=True)
     demo_df.drop_duplicates(inplace=True)
     demo_df.fillna(0, inplace=True)
     return demo_df
 
 
 def static_data_single_table(table_name: str, columns: list) -> pd.DataFrame:
-    conn = init_connection()
-    cur = conn.cursor()
-    str_columns = ', '.join('"{}"'.format(c) for c in columns)
-    query = 'SELECT county_id, {} FROM {} '.format(str_columns, table_name)
-    cur.execute(query)
-    results = cur.fetchall()
-    conn.commit()
-
-    colnames = [desc[0] for desc in cur.description]
-    df = pd.DataFrame(results, columns=colnames)
+    df = select_table(table_name, ['county_id'] + columns)
     # counties_df = all_counties_query()
     # df = counties_df.merge(df, how='outer')
     return df
 
 
 def generic_select_query(table_name: str, columns: list, where: str = None) -> pd.DataFrame:
-    conn = init_connection()
-    cur = conn.cursor()
-    str_columns = ', '.join('"{}"'.format(c) for c in columns)
-    query = 'SELECT {} FROM {} '.format(str_columns, table_name)
-    if where is not None:
-        query += f'WHERE {where}'
-    cur.execute(query)
-    results = cur.fetchall()
-    conn.commit()
-
-    colnames = [desc[0] for desc in cur.description]
-    df = pd.DataFrame(results, columns=colnames)
+    df = select_table(table_name, columns, where)
     return df
 
 
-@st.experimental_memo(ttl=1200)
-def get_county_geoms(counties_list: list, state: str) -> pd.DataFrame:
-    conn = init_connection()
-    counties_list = [_.replace("'", "''") for _ in counties_list]
-    counties = "(" + ",".join(["'" + str(_) + "'" for _ in counties_list]) + ")"
-    cur = conn.cursor()
-    query = f"SELECT * FROM county_geoms WHERE state_name='{state}' AND county_name in {counties};"
-    cur.execute(query)
-    results = cur.fetchall()
-    conn.commit()
+def geometry_coordinates_sql(column: str, tolerance: float, preserve_topology: bool) -> str:
+    # Simplifies, repairs (the buffer(0) step of utils.convert_geom) and rounds geometries to 6 decimals in PostGIS.
+    # Every ring is flattened into one JSON array of [x, y] points, which is what the map layers draw.
+    simplify = 'ST_SimplifyPreserveTopology' if preserve_topology else 'ST_Simplify'
+    return (f"CAST(ST_AsGeoJSON(ST_Points(ST_Force2D(ST_CollectionExtract(ST_MakeValid("
+            f"{simplify}({column}, {tolerance})), 3))), 6)::json -> 'coordinates' AS text)")
 
-    colnames = [desc[0] for desc in cur.description]
-    df = pd.DataFrame(results, columns=colnames)
-    parcels = []
-    for parcel in df['geom']:
-        geom = wkb.loads(parcel, hex=True)
-        parcels.append(geom.simplify(tolerance=0.0001, preserve_topology=True))
-    geom_df = pd.DataFrame()
-    geom_df['county_id'] = df['county_id']
-    geom_df['County Name'] = df['county_name']
-    geom_df['State'] = df['state_name']
-    geom_df['Area sqmi'] = df['sqmi']
-    geom_df['geom'] = pd.Series(parcels)
-    return geom_df
 
+def parse_coordinates(geoms: pd.Series) -> pd.Series:
+    return geoms.apply(lambda x: json.loads(x) if x is not None else [])
 
-@st.experimental_memo(ttl=1200)
-def get_county_geoms_by_id(counties_list: list) -> pd.DataFrame:
-    conn = init_connection()
-    counties = "(" + ",".join(["'" + str(_) + "'" for _ in counties_list]) + ")"
-    cur = conn.cursor()
-    query = f"SELECT * FROM county_geoms WHERE county_id in {counties};"
-    cur.execute(query)
-    results = cur.fetchall()
-    conn.commit()
 
-    colnames = [desc[0] for desc in cur.description]
-    df = pd.DataFrame(results, columns=colnames)
-    parcels = []
-    for parcel in df['geom']:
-        geom = wkb.loads(parcel, hex=True)
-        parcels.append(geom.simplify(tolerance=0.0001, preserve_topology=True))
+def simplify_geoms(geoms: pd.Series, tolerance: float, preserve_topology: bool,
+                   coordinates: bool = False) -> pd.Series:
+    # Decodes and simplifies the whole hex WKB column at once in GEOS
+    parcels = pygeos.simplify(utils.geoms_from_wkb(geoms), tolerance, preserve_topology=preserve_topology)
+    if coordinates:
+        return pd.Series(utils.ring_coordinates_array(parcels), index=geoms.index, dtype=object)
+    return utils.to_geoseries(parcels, index=geoms.index)
+
+
+def county_geoms_query(county_ids: list, coordinates: bool = False) -> pd.DataFrame:
+    columns = ['county_id', 'county_name', 'state_name', 'sqmi']
+    df = geometry.read_geometries('county_geoms', columns, filters=[('county_id', 'in', list(county_ids))],
+                                  coordinates=coordinates)
+    if df is not None:
+        parcels = df['geom']
+    elif coordinates and not snapshot.has_tables('county_geoms'):
+        geom = geometry_coordinates_sql('geom', COUNTY_TOLERANCE, True)
+        condition, params = id_filter('county_geoms.county_id', county_ids)
+        df = copy_query(f"SELECT {', '.join(columns)}, {geom} AS geom FROM county_geoms WHERE {condition};", params)
+        parcels = parse_coordinates(df['geom'])
+    else:
+        df = select_ids('county_geoms', 'county_id', county_ids, columns + ['geom'])
+        parcels = simplify_geoms(df['geom'], COUNTY_TOLERANCE, True, coordinates)
     geom_df = pd.DataFrame()
     geom_df['county_id'] = df['county_id']
     geom_df['County Name'] = df['county_name']
     geom_df['State'] = df['state_name']
     geom_df['Area sqmi'] = df['sqmi']
-    geom_df['geom'] = pd.Series(parcels)
-    return geom_df
-
-
-@st.experimental_memo(ttl=1200)
-def census_tracts_geom_query(counties, state) -> pd.DataFrame:
-    conn = init_connection()
-    cur = conn.cursor()
-    if len(counties) > 1:
-        where_clause = 'WHERE id_index.state_name = ' + "'" + state + "'" + ' ' + 'AND id_index.county_name IN ' + str(
-            tuple(counties))
-    if len(counties) == 1:
-        where_clause = 'WHERE id_index.state_name = ' + "'" + state + "'" + ' ' + 'AND id_index.county_name IN (' + "'" + \
-                       counties[0] + "'" + ')'
-    query = f"""
-        SELECT id_index.county_name, id_index.state_name, census_tracts_geom.tract_id, census_tracts_geom.geom
-        FROM id_index
-        INNER JOIN census_tracts_geom ON census_tracts_geom.tract_id=id_index.tract_id
-        {where_clause};
-    """
-    cur.execute(query)
-    colnames = [desc[0] for desc in cur.description]
-    results = cur.fetchall()
-    conn.commit()
-
-    df = pd.DataFrame(results, columns=colnames)
-    parcels = []
-    for parcel in df['geom']:
-        geom = wkb.loads(parcel, hex=True)
-        parcels.append(geom.simplify(tolerance=0.00005, preserve_topology=False))
+    geom_df['geom'] = parcels
+    return utils.compact_dtypes(geom_df)
+
+
+@cache.cached(tables=['county_geoms'])
+def get_county_geoms(counties_list: list, state: str, coordinates: bool = False) -> pd.DataFrame:
+    # With coordinates=True the geom column holds ready-to-render point lists instead of shapely geometries
+    return county_geoms_query(geo_index.get_geo_index().county_ids(state, counties_list), coordinates)
+
+
+@cache.cached(tables=['county_geoms'])
+def get_county_geoms_by_id(counties_list: list, coordinates: bool = False) -> pd.DataFrame:
+    return county_geoms_query(counties_list, coordinates)
+
+
+@cache.cached(tables=['id_index', 'census_tracts_geom'])
+def census_tracts_geom_query(counties, state, coordinates: bool = False) -> pd.DataFrame:
+    geo = geo_index.get_geo_index()
+    county_ids = geo.county_ids(state, counties)
+    df = None
+    if geometry.store_path('census_tracts_geom') is not None:
+        df = geometry.read_geometries('census_tracts_geom', ['tract_id'], filters=[
+            ('tract_id', 'in', geo.tract_ids(county_ids).tolist())], coordinates=coordinates)
+    if df is not None:
+        parcels = df['geom']
+    elif snapshot.has_tables('census_tracts_geom'):
+        df = snapshot.read_table('census_tracts_geom', ['tract_id', 'geom'], filters=[
+            ('tract_id', 'in', geo.tract_ids(county_ids).tolist())])
+        parcels = simplify_geoms(df['geom'], TRACT_TOLERANCE, False, coordinates)
+    else:
+        geom = 'census_tracts_geom.geom'
+        if coordinates:
+            geom = geometry_coordinates_sql(geom, TRACT_TOLERANCE, False) + ' AS geom'
+        condition, params = id_filter('id_index.county_id', county_ids)
+        query = f"""
+            SELECT id_index.county_name, id_index.state_name, census_tracts_geom.tract_id, {geom}
+            FROM id_index
+            INNER JOIN census_tracts_geom ON census_tracts_geom.tract_id=id_index.tract_id
+            WHERE {condition};
+        """
+        df = copy_query(query, params)
+        if coordinates:
+            parcels = parse_coordinates(df['geom'])
+        else:
+            parcels = simplify_geoms(df['geom'], TRACT_TOLERANCE, False)
     geom_df = pd.DataFrame()
     geom_df['Census Tract'] = df['tract_id']
-    geom_df['geom'] = pd.Series(parcels)
-    return geom_df
-
-
-@st.experimental_memo(ttl=1200)
-def get_transit_stops_geoms(columns: list = [], where: str = None) -> pd.DataFrame:
-    conn = init_connection()
-    if len(columns) > 0:
-        cols = ', '.join(columns)
-        query = f"SELECT {cols} FROM ntm_stops"
-    else:
-        query = f"""SELECT * FROM ntm_stops"""
-    if where is not None:
-        query += f" WHERE {where}"
+    geom_df['geom'] = parcels
+    return utils.compact_dtypes(geom_df)
+
+
+def snapshot_geodataframe(df: pd.DataFrame) -> gpd.GeoDataFrame:
+    df['geom'] = utils.to_geoseries(utils.geoms_from_wkb(df['geom']), index=df.index)
+    return gpd.GeoDataFrame(df, geometry='geom')
+
+
+@instrumentation.timed
+def transit_geoms_query(table: str, columns: list, where: str = None, tract_ids: list = None) -> gpd.GeoDataFrame:
+    filters = [('tract_id', 'in', list(tract_ids))] if tract_ids is not None else None
+    df = snapshot.read_table(table, columns or None, where, filters)
+    if df is not None:
+        return snapshot_geodataframe(df)
+
+    cols = ', '.join(columns) if len(columns) > 0 else '*'
+    conditions = [where] if where is not None else []
+    params, temp_tables = None, []
+    if tract_ids is not None:
+        condition, params = id_filter(f'{table}.tract_id', tract_ids, temp_tables)
+        conditions.append(condition)
+    query = f"SELECT {cols} FROM {table}"
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(f'({c})' for c in conditions)
     query += ';'
-    df = gpd.read_postgis(query, conn)
+    with get_connection() as conn:
+        create_id_tables(conn.cursor(), temp_tables)
+        df = gpd.read_postgis(query, conn, params=params or None)
     return df
 
 
-@st.experimental_memo(ttl=1200)
-def get_transit_shapes_geoms(columns: list = [], where: str = None) -> pd.DataFrame:
-    conn = init_connection()
-    if len(columns) > 0:
-        cols = ', '.join(columns)
-        query = f"SELECT {cols} FROM ntm_shapes"
-    else:
-        query = f"""SELECT * FROM ntm_shapes"""
-    if where is not None:
-        query += f" WHERE {where}"
-    query += ';'
-    df = gpd.read_postgis(query, conn)
+@cache.cached(tables=['ntm_stops'])
+def get_transit_stops_geoms(columns: list = [], where: str = None, tract_ids: list = None) -> pd.DataFrame:
+    return transit_geoms_query('ntm_stops', columns, where, tract_ids)
+
+
+@cache.cached(tables=['ntm_shapes'])
+def get_transit_shapes_geoms(columns: list = [], where: str = None, tract_ids: list = None) -> pd.DataFrame:
+    df = transit_geoms_query('ntm_shapes', columns, where, tract_ids)
     df.drop_duplicates(subset=['geom'], inplace=True)
     return df
 
 
-@st.experimental_memo(ttl=1200)
+@cache.cached(tables=['id_index'] + list(STATIC_COLUMNS))
 def static_data_all_table() -> pd.DataFrame:
     counties_df = all_counties_query()
     for table_name in STATIC_TABLES:
@@ -587,42 +1203,34 @@ def output_data(df: pd.DataFrame, table_name: str = 'fred_tables', ext: str = 'x
     return path
 
 
+@instrumentation.timed
 def fmr_data():
-    conn = init_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT state_full as "State", countyname as "County Name" FROM fair_market_rents;')
-    colnames = [desc[0] for desc in cur.description]
-    results = cur.fetchall()
-    conn.commit()
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT state_full as "State", countyname as "County Name" FROM fair_market_rents;')
+        colnames = [desc[0] for desc in cur.description]
+        results = cur.fetchall()
 
     return pd.DataFrame(results, columns=colnames)
 
 
 def filter_state(data: pd.DataFrame, state: str) -> pd.DataFrame:
+    if 'county_id' in data.columns:
+        return data[data['county_id'].isin(geo_index.get_geo_index().state_county_ids(state))]
     return data[data['State'].str.lower() == state.lower()]
 
 
 def filter_counties(data: pd.DataFrame, counties: list) -> pd.DataFrame:
+    if 'county_id' in data.columns:
+        return data[data['county_id'].isin(geo_index.get_geo_index().county_ids_by_name(counties))]
     counties = [_.lower() for _ in counties]
     return data[data['County Name'].str.lower().isin(counties)]
 
 
-@st.experimental_memo(ttl=1200)
+@cache.cached(tables=COUNTY_DATA_TABLES)
 def load_all_data() -> pd.DataFrame:
-    if os.path.exists("Output/all_tables.xlsx"):
-        try:
-            res = input('Previous data found. Use data from local `all_tables.xlsx`? [y/N]')
-            if res.lower() == 'y' or res.lower() == 'yes':
-                df = pd.read_excel('Output/all_tables.xlsx')
-            else:
-                df = get_all_county_data()
-        except:
-            print('Something went wrong with the Excel file. Falling back to database query.')
-            df = get_all_county_data()
-    else:
-        df = get_all_county_data()
-
-    return df
+    # Served from the Parquet snapshot when SOCIAL_DATA_SNAPSHOT is set, see snapshot.py
+    return get_national_county_data()
 
 
 def clean_data(df: pd.DataFrame) -> pd.DataFrame:
@@ -705,7 +1313,7 @@ def clean_climate_data(data: pd.DataFrame, epc: pd.DataFrame) -> pd.DataFrame:
         #        'volcanic_activity', 'wildfire', 'winter_weather'
     risk_score = ['Census Tract', 'geom', 'county_name', 'state_name']+[hazard+ '_risk_score' for hazard in hazards]
 
-    data.fillna(0.0, inplace=True)
+    utils.fill_missing(data, 0.0)
     data = data[risk_score].copy()
     new_column_names = [" ".join([word.capitalize() for word in x]) for x in data.columns.str.split('_')]
     data.columns = new_column_names
@@ -999,25 +1607,27 @@ def get_existing_policies(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
-@st.experimental_memo(ttl=1200)
+@cache.cached(tables=COUNTY_DATA_TABLES)
 def get_county_data(state: str, county_ids: list = None, policy: bool = False):
     df = get_all_county_data(state, county_ids)
 
-    df = clean_data(df)
-    return df
+    return clean_data(df)
 
 
-@st.experimental_memo(ttl=3600)
+@cache.cached(tables=COUNTY_DATA_TABLES)
 def get_national_county_data() -> pd.DataFrame:
-    frames = []
-    for s in STATES:
-        tmp_df = get_county_data(s)
-        frames.append(tmp_df)
-    df = pd.concat(frames)
-    return df
+    demo_df = read_table('county_demographics')
+    demo_df = demo_df[demo_df['state_name'].isin(STATES)]
+    fred_df = fred_query()
+    demo_df = demo_df.merge(fred_df, on='county_id', how='inner', suffixes=('', '_DROP')).filter(
+        regex='^(?!.*_DROP)')
+
+    df = county_data_columns(demo_df)
+    df = clean_data(df)
+    return utils.compact_dtypes(df)
 
 
-@st.experimental_memo(ttl=3600)
+@cache.cached(tables=['county_geoms'])
 def get_national_county_geom_data(counties: list) -> pd.DataFrame:
     frames = []
     for c in counties:
@@ -1028,20 +1638,18 @@ def get_national_county_geom_data(counties: list) -> pd.DataFrame:
 
 
 def test_new_counties():
-    conn = init_connection()
-    cur = conn.cursor()
-    query = f"SELECT * FROM esri_counties;"
-    cur.execute(query)
-    results = cur.fetchall()
-    conn.commit()
-    colnames = [desc[0] for desc in cur.description]
-    esri_df = pd.DataFrame(results, columns=colnames)
-
-    query = f"SELECT * FROM id_index;"
-    cur.execute(query)
-    results = cur.fetchall()
-    conn.commit()
-    colnames = [desc[0] for desc in cur.description]
+    with get_connection() as conn:
+        cur = conn.cursor()
+        query = f"SELECT * FROM esri_counties;"
+        cur.execute(query)
+        results = cur.fetchall()
+        colnames = [desc[0] for desc in cur.description]
+        esri_df = pd.DataFrame(results, columns=colnames)
+
+        query = f"SELECT * FROM id_index;"
+        cur.execute(query)
+        results = cur.fetchall()
+        colnames = [desc[0] for desc in cur.description]
     idx_df = pd.DataFrame(results, columns=colnames)
     idx_df.drop(['index', 'tract_id', 'state_id', 'state_name'], axis=1, inplace=True)
 
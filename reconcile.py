@@ -0,0 +1,76 @@
+import re
+import difflib
+import pandas as pd
+
+import geo_index
+
+# Minimum difflib similarity for an approximate county name match
+APPROXIMATE_CUTOFF = 0.85
+
+# Only 'county' is dropped: keeping 'city', 'parish', etc. keeps e.g. Baltimore County and Baltimore city apart
+_COUNTY_SUFFIX = re.compile(r'\s+county$')
+_PUNCTUATION = re.compile(r"[.'`,]")
+_SPACES = re.compile(r'[\s\-]+')
+
+
+def normalize_states(states: pd.Series) -> pd.Series:
+    return states.astype(str).str.strip().str.lower()
+
+
+def normalize_counties(counties: pd.Series) -> pd.Series:
+    counties = counties.astype(str).str.lower().str.replace(_PUNCTUATION, '', regex=True)
+    counties = counties.str.replace(_SPACES, ' ', regex=True).str.strip()
+    counties = counties.str.replace(r'^st\b', 'saint', regex=True).str.replace(r'^ste\b', 'sainte', regex=True)
+    return counties.str.replace(_COUNTY_SUFFIX, '', regex=True)
+
+
+def reconcile_counties(df: pd.DataFrame, state_column: str, county_column: str, counties: pd.DataFrame = None,
+                       cutoff: float = APPROXIMATE_CUTOFF) -> tuple:
+    # Maps (state name, county name) pairs onto county_id in one join on normalized keys. Names left over are
+    # matched approximately against the counties of their own state only. Returns the IDs aligned with df's
+    # index and a report with one row per distinct name that wasn't matched exactly.
+    if counties is None:
+        counties = geo_index.get_geo_index().counties_frame()
+    reference = pd.DataFrame({
+        'state_key': normalize_states(counties['state_name']),
+        'county_key': normalize_counties(counties['county_name']),
+        'matched_name': counties['county_name'],
+        'county_id': counties['county_id'],
+    }).drop_duplicates(['state_key', 'county_key'])
+
+    keys = pd.DataFrame({
+        'state_key': normalize_states(df[state_column]),
+        'county_key': normalize_counties(df[county_column]),
+        'state': df[state_column],
+        'name': df[county_column],
+    }, index=df.index)
+    exact = keys.join(reference.set_index(['state_key', 'county_key']), on=['state_key', 'county_key'])
+
+    missing = exact[exact['county_id'].isna()].drop_duplicates(['state_key', 'county_key'])
+    candidates = {state: list(group) for state, group in reference.groupby('state_key')['county_key']}
+    approximate = []
+    for state_key, county_key in zip(missing['state_key'], missing['county_key']):
+        match = difflib.get_close_matches(county_key, candidates.get(state_key, []), n=1, cutoff=cutoff)
+        if match:
+            score = difflib.SequenceMatcher(None, county_key, match[0]).ratio()
+            approximate.append((state_key, county_key, match[0], round(score, 3)))
+    approximate = pd.DataFrame(approximate, columns=['state_key', 'county_key', 'match_key', 'score'])
+    approximate = approximate.merge(reference.rename(columns={'county_key': 'match_key'}),
+                                    on=['state_key', 'match_key'])
+
+    fallback = keys.join(approximate.set_index(['state_key', 'county_key'])[['county_id', 'matched_name', 'score']],
+                         on=['state_key', 'county_key'])
+    county_ids = exact['county_id'].fillna(fallback['county_id'])
+
+    report = fallback.loc[exact['county_id'].isna()].drop_duplicates(['state_key', 'county_key'])
+    report = report.assign(match=report['county_id'].notna().map({True: 'approximate', False: 'unmatched'}))
+    report = report[['state', 'name', 'matched_name', 'county_id', 'score', 'match']].reset_index(drop=True)
+    return county_ids, report
+
+
+def print_report(county_ids: pd.Series, report: pd.DataFrame):
+    counts = report['match'].value_counts()
+    print(f"{county_ids.notna().sum()} of {len(county_ids)} rows mapped to a county_id; "
+          f"{counts.get('approximate', 0)} names matched approximately, {counts.get('unmatched', 0)} unmatched")
+    if not report.empty:
+        print(report.to_string(index=False))
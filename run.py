@@ -5,10 +5,12 @@ import streamlit as st
 import data_explorer
 import eviction_analysis
 import equity_explorer
+import geo_index
+import instrumentation
 import queries
 import analysis
+import classification
 import utils
-from constants import STATES
 
 # Pandas options
 pd.set_option('max_rows', 25)
@@ -43,6 +45,7 @@ def print_summary(df: pd.DataFrame, output: str):
 
 
 def run_shell() -> pd.DataFrame:
+    instrumentation.set_page('shell')
     task = input(
         'Analyze a single county (1), multiple counties (2), all the counties in a state (3), or a nation-wide analysis (4)? [default: 1]') \
         .strip()
@@ -54,7 +57,7 @@ def run_shell() -> pd.DataFrame:
         cost_of_evictions.strip()
         county = res[0].strip().lower()
         state = res[1].strip().lower()
-        df = queries.get_county_data(state, [county])
+        df = queries.get_county_data(state, geo_index.get_geo_index().county_ids(state, [county]))
 
         if cost_of_evictions == 'y' or cost_of_evictions == '':
             df = analysis.calculate_cost_estimate(df, rent_type='fmr')
@@ -65,7 +68,7 @@ def run_shell() -> pd.DataFrame:
     elif task == '2':
         state = input("Which state are you looking for? (ie: California)").strip()
         counties = input('Please specify one or more counties, separated by commas.').strip().split(',')
-        df = queries.get_county_data(state, counties)
+        df = queries.get_county_data(state, geo_index.get_geo_index().county_ids(state, counties))
         cost_of_evictions = input(
             'Run an analysis to estimate the cost to avoid evictions? (Y/n) ')
         if cost_of_evictions == 'y' or cost_of_evictions == '':
@@ -93,11 +96,7 @@ def run_shell() -> pd.DataFrame:
         df = df.merge(geom, on='County Name', how='outer')
         return df
     elif task == '4':
-        frames = []
-        for state in STATES:
-            df = queries.get_county_data(state)
-            frames.append(df)
-        natl_df = pd.concat(frames)
+        natl_df = queries.get_national_county_data()
         cost_of_evictions = input(
             'Run an analysis to estimate the cost to avoid evictions (Y/n) ')
         if cost_of_evictions == 'y' or cost_of_evictions == '':
@@ -155,6 +154,10 @@ def run_UI():
         page=st.sidebar.radio('Navigation', PAGES, index=1)
 
     st.experimental_set_query_params(page=page)
+    instrumentation.set_page(page)
+    st.session_state.classification_scheme = st.sidebar.selectbox(
+        'Map classification', classification.SCHEMES,
+        classification.SCHEMES.index(st.session_state.classification_scheme))
 
     if page == 'Eviction Analysis':
         st.sidebar.write("""
@@ -195,6 +198,8 @@ def run_UI():
         else:
             data_explorer.census_data_explorer()
 
+    instrumentation.diagnostics_panel()
+
 
 if __name__ == '__main__':
 
@@ -210,6 +215,7 @@ if __name__ == '__main__':
             st.session_state.page = PAGES.index(url_params['page'][0])
             st.session_state['data_type'] = 'County Level'
             st.session_state['data_format'] = 'Raw Values'
+            st.session_state['classification_scheme'] = classification.DEFAULT_SCHEME
             st.session_state['loaded'] = False
 
         run_UI()
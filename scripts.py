@@ -1,43 +1,65 @@
+import etl
 import queries
+import reconcile
+import spatial_join
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from sqlalchemy import create_engine
-import psycopg2
-import credentials
 
 
 def init_engine():
-    engine = create_engine(
-        f'postgresql://{credentials.DB_USER}:{credentials.DB_PASSWORD}@{credentials.DB_HOST}:{credentials.DB_PORT}/{credentials.DB_NAME}')
-    return engine
+    # Shared, pooled engine so scripts reuse connections with the query helpers
+    return queries.init_engine()
 
 
 def fix_chmura_counties():
-    counties = queries.all_counties_query()
-    counties.set_index(['State', 'County Name'], inplace=True)
     ch_df = queries.generic_select_query('chmura_economic_vulnerability_index',
                                          ['fips', 'name', 'VulnerabilityIndex', 'Rank', 'state', 'county_id'])
-    for i, row in ch_df.iterrows():
-        if pd.isnull(row['county_id']):
-            try:
-                ch_df.at[i, 'county_id'] = counties.loc[row['state'], row['name']]['county_id']
-            except KeyError:
-                print(row['state'], row['name'])
+    missing = ch_df['county_id'].isna()
+    county_ids, report = reconcile.reconcile_counties(ch_df[missing], 'state', 'name')
+    ch_df.loc[missing, 'county_id'] = county_ids
+    reconcile.print_report(county_ids, report)
 
     queries.write_table(ch_df, 'chmura_economic_vulnerability_index')
 
 
-def populate_table(path: str, name: str):
-    engine = init_engine()
-    df = pd.read_csv(path)
-    df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
+def csv_dtypes(path: str, chunksize: int = queries.READ_CHUNK_SIZE) -> dict:
+    # Dtypes that fit every row of the file. Each chunk of a chunked read infers its own, so a first pass
+    # merges them: a column stays integer only if it is in every chunk, numbers mixed with text become text.
+    dtypes = {}
+    for df in pd.read_csv(path, chunksize=chunksize, low_memory=False):
+        for column, dtype in df.dtypes.items():
+            seen = dtypes.setdefault(column, dtype)
+            if seen == dtype:
+                continue
+            if pd.api.types.is_numeric_dtype(seen) and pd.api.types.is_numeric_dtype(dtype) \
+                    and not pd.api.types.is_bool_dtype(seen) and not pd.api.types.is_bool_dtype(dtype):
+                dtypes[column] = np.dtype('float64')
+            else:
+                dtypes[column] = np.dtype(object)
+    return dtypes
+
+
+def populate_table(path: str, name: str, chunksize: int = queries.READ_CHUNK_SIZE, keys: list = None):
+    # With `keys`, only rows that are new or changed are written (see queries.upsert_table_chunks)
+    dtypes = csv_dtypes(path, chunksize)
+    chunks = (df.loc[:, ~df.columns.str.contains('^Unnamed')]
+              for df in pd.read_csv(path, chunksize=chunksize, dtype=dtypes, low_memory=False))
 
     # df.drop(['OBJECTID'], inplace=True, axis=1)
     # df.replace('N', None, inplace=True)
-    print(df.columns)
 
-    df.to_sql(name, engine, if_exists='replace', method='multi', index=False)
-    print('write complete')
+    if keys:
+        print_upsert(name, queries.upsert_table_chunks(chunks, name, keys))
+    else:
+        rows = queries.write_table_chunks(chunks, name)
+        print(f'write complete ({rows} rows)')
+
+
+def print_upsert(table: str, counts: dict):
+    unchanged = counts['incoming'] - counts['inserted'] - counts['updated'] - counts['skipped']
+    print(f"{table}: {counts['inserted']} inserted, {counts['updated']} updated, {unchanged} unchanged, "
+          f"{counts['skipped']} skipped (NULL or repeated keys)")
 
 
 def import_geojson():
@@ -61,58 +83,64 @@ FRED_TABLES = [
 ]
 
 
-def update_FRED():
-    engine = init_engine()
-    ch_df = queries.read_table('chmura_economic_vulnerability_index')
-    keep_cols = {'date', 'value', 'fips', 'state_name', 'county_name', 'rent50_0', 'rent50_1',
-                 'rent50_2', 'rent50_3', 'rent50_4', 'pop2017', 'hu2017', 'fmr_0', 'fmr_1', 'fmr_2',
-                 'fmr_3', 'fmr_4', 'pop2017', 'fmr_pct_chg', 'fmr_dollar_chg'}
-    big_df = pd.DataFrame()
-    frames = []
-    for table in FRED_TABLES:
-        df = queries.read_table(table)
-        df = df.merge(ch_df, on='county_id')
-        print(df.columns)
-        drop_cols = list(set(df.columns) - keep_cols)
-        df.drop(drop_cols, axis=1, inplace=True)
-        df.replace('.', None, inplace=True)
-        df.rename({"value": table, 'fips': 'county_id'}, axis=1, inplace=True)
-        # df.to_csv('temp/temp.csv')
-        df.to_sql(f"{table}_new", engine, if_exists='replace', method='multi', index=False)
-        print(df.head())
-
-
-def map_ntm():
-    conn = queries.init_connection()
-    query = """
-    SELECT a.route_type_text, a.route_long_name, a.route_desc,a.length, a.geom, b.tract_id
-    FROM ntm_shapes a, census_tracts_geom b, id_index c
-    WHERE ST_Intersects(a.geom, b.geom);
-    """
-    #     query="""
-    # SELECT a.stop_name, a.stop_lat, a.stop_lon, a.wheelchair_boarding,a.direction, a.geom, b.tract_id
-    # FROM ntm_stops a, census_tracts_geom b
-    # WHERE ST_CoveredBy(a.geom, b.geom);
-    #     """
-
-    # df = pd.read_sql(query, con=conn)
-    # df.to_csv('temp/new_ntm_shapes.csv')
-    df=pd.read_csv('temp/new_ntm_shapes.csv',low_memory=False)
-    # df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
-    print(df.shape)
-    print(df.dtypes)
-    print(df.describe())
+FRED_KEEP_COLUMNS = {'date', 'value', 'fips', 'state_name', 'county_name', 'rent50_0', 'rent50_1',
+                     'rent50_2', 'rent50_3', 'rent50_4', 'pop2017', 'hu2017', 'fmr_0', 'fmr_1', 'fmr_2',
+                     'fmr_3', 'fmr_4', 'pop2017', 'fmr_pct_chg', 'fmr_dollar_chg'}
 
-    # df.drop(['OBJECTID'], inplace=True, axis=1)
-    # df.replace('N', None, inplace=True)
-    engine = init_engine()
-    df.to_sql('ntm_shapes_new', engine, if_exists='replace', method='multi', index=False)
-    print('write complete')
 
-    # df=pd.read_csv('temp/new_ntm_stops.csv')
-    # print(df.shape)
-    # print(df.dtypes)
-    # print(df.describe())
+def clean_FRED_chunk(df: pd.DataFrame, ch_df: pd.DataFrame, table: str) -> pd.DataFrame:
+    df = df.merge(ch_df, on='county_id')
+    drop_cols = list(set(df.columns) - FRED_KEEP_COLUMNS)
+    df.drop(drop_cols, axis=1, inplace=True)
+    df = df.replace({'.': None})
+    df.rename({"value": table, 'fips': 'county_id'}, axis=1, inplace=True)
+    return df
+
+
+FRED_KEYS = ['county_id', 'date']
+
+
+def update_FRED_table(table: str, chunksize: int = queries.READ_CHUNK_SIZE, incremental: bool = False) -> bool:
+    # Rebuilds (or, incrementally, upserts on FRED_KEYS) one {table}_new table. Returns whether it changed.
+    ch_df = queries.read_table('chmura_economic_vulnerability_index')
+    chunks = (clean_FRED_chunk(df, ch_df, table) for df in queries.read_table_chunks(table, chunksize=chunksize))
+    if incremental:
+        counts = queries.upsert_table_chunks(chunks, f"{table}_new", FRED_KEYS)
+        print_upsert(f"{table}_new", counts)
+        return bool(counts['inserted'] or counts['updated'])
+    rows = queries.write_table_chunks(chunks, f"{table}_new")
+    print(f'{table}_new: {rows} rows written')
+    return True
+
+
+def update_FRED(chunksize: int = queries.READ_CHUNK_SIZE, incremental: bool = False):
+    # The incremental mode skips the FRED_LATEST_TABLE refresh when nothing changed
+    changed = [update_FRED_table(table, chunksize, incremental) for table in FRED_TABLES]
+    if any(changed):
+        queries.refresh_fred_latest()
+        print(f'{queries.FRED_LATEST_TABLE} refreshed')
+
+
+def map_ntm(workers: int = None):
+    # Tract assignment runs locally with an R-tree per state instead of the ST_Intersects cross join,
+    # which was too slow to finish (see spatial_join.py)
+    rows = spatial_join.map_transit('ntm_shapes', 'ntm_shapes_new', spatial_join.SHAPE_COLUMNS, 'intersects', workers)
+    print(f'ntm_shapes_new: {rows} rows written')
+    rows = spatial_join.map_transit('ntm_stops', 'ntm_stops_new', spatial_join.STOP_COLUMNS, 'covered_by', workers)
+    print(f'ntm_stops_new: {rows} rows written')
+
+
+def refresh_jobs(incremental: bool = False) -> list:
+    # Dependency graph of a full refresh for etl.run_jobs. The FRED tables are merged with chmura's
+    # county IDs, so they wait for fix_chmura_counties; each table is its own job.
+    fred_jobs = [etl.Job(f'fred:{table}', update_FRED_table, (table, queries.READ_CHUNK_SIZE, incremental),
+                         ['fix_chmura_counties']) for table in FRED_TABLES]
+    return [
+        etl.Job('fix_chmura_counties', fix_chmura_counties),
+        *fred_jobs,
+        etl.Job('fred_latest', queries.refresh_fred_latest, requires=[job.name for job in fred_jobs]),
+        etl.Job('map_ntm', map_ntm),
+    ]
 
 
 if __name__ == '__main__':
@@ -120,5 +148,6 @@ if __name__ == '__main__':
     # import_geojson()
     # populate_table('temp/new_ntm_stops.csv', 'ntm_stops_new')
     # update_FRED()
+    # queries.refresh_fred_latest()
     map_ntm()
     pass
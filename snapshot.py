@@ -0,0 +1,188 @@
+import os
+import re
+import sys
+import json
+import datetime
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Reads are only served from a snapshot when this points at an exported directory
+SNAPSHOT_ENV = 'SOCIAL_DATA_SNAPSHOT'
+SNAPSHOT_DIR = 'Output/snapshot'
+MANIFEST_FILE = 'manifest.json'
+
+GEOMETRY_TABLES = [
+    'county_geoms',
+    'census_tracts_geom',
+    'ntm_shapes',
+    'ntm_stops',
+]
+
+_manifest = None
+_manifest_mtime = None
+
+# Splits a WHERE clause on AND outside of quoted literals
+_AND = re.compile(r"\s+and\s+(?=(?:[^']*'[^']*')*[^']*$)", re.IGNORECASE)
+_CONDITION = re.compile(r"^(?:\w+\.)?\"?(\w+)\"?\s*(=|\bin\b)\s*(.+)$", re.IGNORECASE | re.DOTALL)
+_LITERAL = re.compile(r"'((?:[^']|'')*)'|([^,\s()]+)")
+
+
+def snapshot_dir() -> str:
+    return os.environ.get(SNAPSHOT_ENV) or SNAPSHOT_DIR
+
+
+def snapshot_tables() -> list:
+    import queries
+    tables = ['county_demographics', 'id_index', queries.FRED_LATEST_TABLE, 'policy', 'housing_stock_distribution']
+    tables += [f'{table_name}_new' for table_name in queries.FRED_TABLES]
+    tables += list(queries.STATIC_COLUMNS) + ['fair_market_rents_new', 'median_rents_new']
+    tables += queries.CENSUS_TABLES + queries.CLIMATE_CENSUS_TABLES
+    tables += GEOMETRY_TABLES
+    return list(dict.fromkeys(tables))
+
+
+def export_snapshot(path: str = None, tables: list = None) -> dict:
+    # Copies each table out of Postgres as typed Arrow columns and writes one Parquet file per table
+    import queries
+    path = path or snapshot_dir()
+    tables = tables or snapshot_tables()
+    os.makedirs(path, exist_ok=True)
+    existing = set(queries.table_names_query())
+    created = datetime.datetime.utcnow().isoformat()
+    manifest = {'created': created, 'tables': {}}
+
+    for table_name in tables:
+        if table_name not in existing:
+            print(f'Skipping {table_name}: table not found in the database.')
+            continue
+        table = queries.copy_query_arrow(f'SELECT * FROM {table_name};')
+        file_name = f'{table_name}.parquet'
+        pq.write_table(table, os.path.join(path, file_name), compression='snappy')
+        manifest['tables'][table_name] = {
+            'file': file_name,
+            'rows': table.num_rows,
+            'columns': table.column_names,
+            'version': created,
+        }
+        print(f'Exported {table_name} ({table.num_rows} rows).')
+
+    # The manifest is written last, so a partial export is never picked up by readers
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return manifest
+
+
+def load_manifest() -> dict:
+    global _manifest, _manifest_mtime
+    if not os.environ.get(SNAPSHOT_ENV):
+        return None
+    manifest_path = os.path.join(snapshot_dir(), MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    mtime = os.path.getmtime(manifest_path)
+    if _manifest is None or mtime != _manifest_mtime:
+        with open(manifest_path) as f:
+            _manifest = json.load(f)
+        _manifest_mtime = mtime
+    return _manifest
+
+
+def enabled() -> bool:
+    return load_manifest() is not None
+
+
+def has_tables(*tables) -> bool:
+    manifest = load_manifest()
+    return manifest is not None and all(t in manifest['tables'] for t in tables)
+
+
+def table_columns(table: str) -> list:
+    return load_manifest()['tables'][table]['columns']
+
+
+def _parse_literal(value: str):
+    match = _LITERAL.fullmatch(value.strip())
+    if match is None:
+        return None
+    if match.group(1) is not None:
+        return match.group(1).replace("''", "'")
+    return match.group(2)
+
+
+def where_to_filters(where: str) -> list:
+    # Translates the simple `col = 'x'` / `col in ('x', 'y')` clauses used across queries into Parquet
+    # filters. Returns None for anything else so the caller can fall back to the database.
+    where = where.strip().rstrip(';').strip()
+    if where.lower().startswith('where '):
+        where = where[6:]
+    filters = []
+    for condition in _AND.split(where):
+        match = _CONDITION.match(condition.strip())
+        if match is None:
+            return None
+        column, op, value = match.group(1), match.group(2).lower(), match.group(3).strip()
+        if op == '=':
+            value = _parse_literal(value)
+            if value is None:
+                return None
+            filters.append((column, '=', value))
+        else:
+            if not (value.startswith('(') and value.endswith(')')):
+                return None
+            values = [a if a else b for a, b in _LITERAL.findall(value[1:-1])]
+            filters.append((column, 'in', [v.replace("''", "'") for v in values]))
+    return filters
+
+
+def cast_filters(filters: list, schema: pa.Schema) -> list:
+    # Filter values arrive as SQL text, so they are converted to the column's type before comparing
+    cast = []
+    for column, op, value in filters:
+        if column not in schema.names:
+            return None
+        field_type = schema.field(column).type
+        if pa.types.is_integer(field_type):
+            convert = lambda v: int(float(v))
+        elif pa.types.is_floating(field_type):
+            convert = float
+        else:
+            convert = str
+        try:
+            value = [convert(v) for v in value] if op == 'in' else convert(value)
+        except ValueError:
+            return None
+        cast.append((column, op, value))
+    return cast
+
+
+def read_parquet(path: str, columns: list = None, where: str = None, filters: list = None) -> pd.DataFrame:
+    # Memory-mapped read with column projection and row filtering. Returns None when the predicate can't be
+    # expressed as Parquet filters.
+    if where is not None:
+        where_filters = where_to_filters(where)
+        if where_filters is None:
+            return None
+        filters = (filters or []) + where_filters
+    if filters:
+        filters = cast_filters(filters, pq.read_schema(path))
+        if filters is None:
+            return None
+    if columns is not None:
+        columns = list(dict.fromkeys(columns))
+    arrow_table = pq.read_table(path, columns=columns, filters=filters or None, memory_map=True)
+    return arrow_table.to_pandas()
+
+
+def read_table(table: str, columns: list = None, where: str = None, filters: list = None) -> pd.DataFrame:
+    # Returns None when the table is not in the snapshot or can't be read from it
+    if not has_tables(table):
+        return None
+    path = os.path.join(snapshot_dir(), load_manifest()['tables'][table]['file'])
+    return read_parquet(path, columns, where, filters)
+
+
+if __name__ == '__main__':
+    export_snapshot(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,70 @@
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import pygeos
+
+import etl
+import geo_index
+import queries
+import utils
+
+SHAPE_COLUMNS = ['route_type_text', 'route_long_name', 'route_desc', 'length']
+STOP_COLUMNS = ['stop_name', 'stop_lat', 'stop_lon', 'wheelchair_boarding', 'direction']
+
+
+def table_srid(table: str, column: str = 'geom') -> int:
+    with queries.get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT Find_SRID('public', %s, %s);", (table, column))
+        return cur.fetchone()[0]
+
+
+def join_state(state: str, tract_ids: list, table: str, columns: list, predicate: str) -> pd.DataFrame:
+    # Assigns the features of `table` to the state's tracts with a bulk-loaded STRtree. Only features whose
+    # bounding box overlaps the state's tracts are read.
+    tracts = queries.select_ids('census_tracts_geom', 'tract_id', tract_ids, ['tract_id', 'geom'])
+    tract_geoms = utils.geoms_from_wkb(tracts['geom'])
+    if len(tract_geoms) == 0:
+        return pd.DataFrame(columns=columns + ['geom', 'tract_id'])
+    xmin, ymin, xmax, ymax = pygeos.total_bounds(tract_geoms)
+
+    cols = ', '.join('"{}"'.format(c) for c in columns)
+    df = queries.copy_query(f"SELECT {cols}, geom FROM {table} WHERE geom && ST_MakeEnvelope(%s, %s, %s, %s, %s);",
+                            (float(xmin), float(ymin), float(xmax), float(ymax), table_srid(table)))
+    geoms = utils.geoms_from_wkb(df['geom'])
+
+    tree = pygeos.STRtree(tract_geoms)
+    feature_index, tract_index = tree.query_bulk(geoms, predicate=predicate)
+    result = df.iloc[feature_index].reset_index(drop=True)
+    result['tract_id'] = tracts['tract_id'].to_numpy()[tract_index]
+    print(f'{table} {state}: {len(df)} features, {len(result)} tract matches')
+    return result
+
+
+def map_transit(table: str, output: str, columns: list, predicate: str, workers: int = None) -> int:
+    # Joins `table` to census tracts one state at a time across worker processes and streams each state's
+    # matches into `output` as it finishes. The table is swapped in once every state is written. Workers are
+    # spawned: they start while the write connection holds an open COPY, and this may itself run in an ETL worker.
+    geo = geo_index.get_geo_index()
+    states = [(state, geo.tract_ids(geo.state_county_ids(state)).tolist()) for state in geo.states]
+    workers = workers or etl.ETL_WORKERS
+
+    def chunks():
+        if workers == 1:
+            for state, tract_ids in states:
+                yield join_state(state, tract_ids, table, columns, predicate)
+            return
+        with ProcessPoolExecutor(max_workers=workers, mp_context=etl.spawn_context(),
+                                 initializer=etl.init_worker) as executor:
+            futures = [executor.submit(join_state, state, tract_ids, table, columns, predicate)
+                       for state, tract_ids in states]
+            for future in futures:
+                yield future.result()
+
+    return queries.write_table_chunks((df for df in chunks() if not df.empty), output,
+                                      geometry_columns=['geom'])
+
+
+if __name__ == '__main__':
+    map_transit('ntm_shapes', 'ntm_shapes_new', SHAPE_COLUMNS, 'intersects',
+                int(sys.argv[1]) if len(sys.argv) > 1 else None)
@@ -3,8 +3,14 @@ import pandas as pd
 import numpy as np
 from six import BytesIO
 import geopandas as gpd
+import pygeos
 import streamlit as st
 
+# Repeated on every row of county and tract frames, so stored as categoricals
+NAME_COLUMNS = ['State', 'County Name', 'county_name', 'state_name']
+ID_COLUMNS = ['county_id', 'tract_id', 'Census Tract', 'fips']
+INT32_MIN, INT32_MAX = np.iinfo(np.int32).min, np.iinfo(np.int32).max
+
 def to_excel(df: pd.DataFrame):
     output = BytesIO()
     writer = pd.ExcelWriter(output, engine='xlsxwriter')
@@ -29,49 +35,59 @@ def output_table(df: pd.DataFrame, path: str):
     df.to_excel(path)
 
 
-def make_geojson(geo_df: pd.DataFrame, features: list) -> dict:
-    geojson = {"type": "FeatureCollection", "features": []}
-    if 'Census Tract' in geo_df.columns:
-        for i, row in geo_df.iterrows():
-            feature = row['coordinates']['features'][0]
-            props = {"name": str(row['Census Tract'])}
-            [props.update({f: row[f]}) for f in features]
-            feature["properties"] = props
-            del feature["id"]
-            del feature["bbox"]
-            feature["geometry"]["coordinates"] = [feature["geometry"]["coordinates"]]
-            geojson["features"].append(feature)
-    elif 'Census Tract' not in geo_df.columns:
-        for i, row in geo_df.iterrows():
-            feature = row['coordinates']['features'][0]
-            props = {"name": row['County Name']}
-            [props.update({f: row[f]}) for f in features]
-            feature["properties"] = props
-            del feature["id"]
-            del feature["bbox"]
-            feature["geometry"]["coordinates"] = [feature["geometry"]["coordinates"]]
-            geojson["features"].append(feature)
-    return geojson
-
-
-def convert_coordinates(row) -> list:
-    for f in row['coordinates']['features']:
-        new_coords = []
-        if f['geometry']['type'] == 'MultiPolygon':
-            f['geometry']['type'] = 'Polygon'
-            combined = []
-            for i in range(len(f['geometry']['coordinates'])):
-                combined.extend(list(f['geometry']['coordinates'][i]))
-            f['geometry']['coordinates'] = combined
-        coords = f['geometry']['coordinates']
-        for coord in coords:
-            for point in coord:
-                new_coords.append([round(point[0], 6), round(point[1], 6)])
-        f['geometry']['coordinates'] = new_coords
-    return row['coordinates']
+def geoms_from_wkb(values) -> np.ndarray:
+    # Decodes a whole column of WKB (bytes or hex strings) in one call; missing values stay None
+    return pygeos.from_wkb(np.asarray(values, dtype=object))
 
 
-def convert_geom(geo_df: pd.DataFrame, data_df: pd.DataFrame, map_features: list) -> dict:
+def geoms_from_shapely(values) -> np.ndarray:
+    return pygeos.from_shapely(np.asarray(values, dtype=object))
+
+
+def to_geoseries(geoms: np.ndarray, index=None) -> gpd.GeoSeries:
+    return gpd.GeoSeries.from_wkb(pygeos.to_wkb(geoms), index=index)
+
+
+def split_coordinates(coords: np.ndarray, index: np.ndarray, n: int) -> list:
+    # Splits the flat output of get_coordinates(return_index=True) back into one array per geometry
+    return np.split(coords, np.searchsorted(index, np.arange(1, n)))
+
+
+def ring_coordinates_array(geoms: np.ndarray, flat: bool = False) -> list:
+    # Every ring of each (multi)polygon, repaired with buffer(0) and flattened into one list of points
+    # rounded to 6 decimals. With flat=True each list is [x0, y0, x1, y1, ...] instead of [[x0, y0], ...].
+    geoms = pygeos.buffer(geoms, 0)
+    coords, index = pygeos.get_coordinates(geoms, return_index=True)
+    coords = np.round(coords, 6)
+    parts = split_coordinates(coords, index, len(geoms))
+    return [part.ravel().tolist() if flat else part.tolist() for part in parts]
+
+
+def line_paths(geoms: np.ndarray) -> list:
+    # Vectorised coord_extractor: a point list per line, or a list of point lists for multi-part geometries
+    parts, part_index = pygeos.get_parts(geoms, return_index=True)
+    coords, coord_index = pygeos.get_coordinates(parts, return_index=True)
+    multi = np.isin(pygeos.get_type_id(geoms), [4, 5, 6])
+    paths = [[] for _ in range(len(geoms))]
+    for i, part in zip(part_index, split_coordinates(coords, coord_index, len(parts))):
+        paths[i].append(part.tolist())
+    return [path if multi[i] else (path[0] if path else []) for i, path in enumerate(paths)]
+
+
+def coordinate_list(g, flat: bool = False) -> list:
+    # Point list of a geometry loaded with coordinates=True. It arrives as nested numpy arrays rather than
+    # lists when the frame was read back from Parquet; anything else (missing geometry) is empty.
+    if isinstance(g, list) and not flat:
+        return g
+    if not isinstance(g, (list, np.ndarray)):
+        return []
+    points = np.array(list(g), dtype=float).reshape(-1, 2)
+    return points.ravel().tolist() if flat else points.tolist()
+
+
+def map_frame(geo_df: pd.DataFrame, data_df: pd.DataFrame, map_features: list, flat: bool = False) -> pd.DataFrame:
+    # Joins the map features onto the geometries and adds `name` and render-ready `coordinates` columns,
+    # flat XY lists with flat=True. The geom column is dropped.
     if 'Census Tract' not in data_df:
         data_df = data_df[['county_id'] + map_features]
         data_df = data_df.round(3)
@@ -84,12 +100,69 @@ def convert_geom(geo_df: pd.DataFrame, data_df: pd.DataFrame, map_features: list
 
         geo_df = geo_df.merge(data_df, on='Census Tract', suffixes=('', '_DROP')).filter(
             regex='^(?!.*_DROP)')
-    # geo_df.fillna(0,inplace=True)
-    geo_df['geom'] = geo_df.apply(lambda row: row['geom'].buffer(0), axis=1)
-    geo_df['coordinates'] = geo_df.apply(lambda row: gpd.GeoSeries(row['geom']).__geo_interface__, axis=1)
-    geo_df['coordinates'] = geo_df.apply(lambda row: convert_coordinates(row), axis=1)
-    geojson = make_geojson(geo_df, map_features)
-    return geojson
+    geo_df = geo_df.reset_index(drop=True)
+    if 'Census Tract' in geo_df.columns:
+        geo_df['name'] = geo_df['Census Tract'].astype(str)
+    else:
+        geo_df['name'] = geo_df['County Name']
+
+    geoms = geo_df.pop('geom')
+    if geoms.map(lambda g: isinstance(g, (list, np.ndarray))).any():
+        # Loaded with coordinates=True, so already repaired, simplified and rounded
+        geo_df['coordinates'] = [coordinate_list(g, flat) for g in geoms]
+    else:
+        geoms = geoms.astype(object).where(geoms.notna(), None)
+        geo_df['coordinates'] = ring_coordinates_array(geoms_from_shapely(geoms), flat)
+    return geo_df
+
+
+def make_geojson(geo_df: pd.DataFrame, features: list) -> dict:
+    # Builds the FeatureCollection from whole columns of a map_frame: `coordinates` holds one list of rounded
+    # points per row and every feature becomes a single-ring Polygon
+    properties = pd.DataFrame({'name': geo_df['name'].to_numpy()})
+    for f in features:
+        properties[f] = geo_df[f].to_numpy()
+    return {"type": "FeatureCollection", "features": [
+        {"type": "Feature", "properties": props, "geometry": {"type": "Polygon", "coordinates": [coords]}}
+        for props, coords in zip(properties.to_dict('records'), geo_df['coordinates'])
+    ]}
+
+
+def convert_geom(geo_df: pd.DataFrame, data_df: pd.DataFrame, map_features: list) -> dict:
+    return make_geojson(map_frame(geo_df, data_df, map_features), map_features)
+
+
+def compact_ids(series: pd.Series) -> pd.Series:
+    # Integral IDs become nullable ints, so missing IDs no longer force a float column
+    values = series.dropna()
+    if pd.api.types.is_float_dtype(series) and not (values % 1 == 0).all():
+        return series
+    fits = values.empty or (values.min() >= INT32_MIN and values.max() <= INT32_MAX)
+    return series.astype('Int32' if fits else 'Int64')
+
+
+def compact_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    # Shrinks frames before they are cached: names become categoricals and IDs nullable ints. Measure columns
+    # keep their float64/int64 dtypes, since thresholds, rankings and per-capita maths are computed on them.
+    for column in df.columns.unique():
+        series = df[column]
+        if isinstance(series, pd.DataFrame) or column == 'geom' or pd.api.types.is_bool_dtype(series):
+            continue
+        if column in NAME_COLUMNS and pd.api.types.is_object_dtype(series):
+            df[column] = series.astype('category')
+        elif column in ID_COLUMNS and pd.api.types.is_numeric_dtype(series):
+            df[column] = compact_ids(series)
+    return df
+
+
+def is_text(series: pd.Series) -> bool:
+    return pd.api.types.is_object_dtype(series) or pd.api.types.is_categorical_dtype(series)
+
+
+def fill_missing(df: pd.DataFrame, value):
+    # In-place fillna for every column except categoricals, which can't take a value outside their categories
+    columns = [c for c in df.columns if not pd.api.types.is_categorical_dtype(df[c])]
+    df[columns] = df[columns].fillna(value)
 
 
 def coord_extractor(input_geom):
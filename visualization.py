@@ -3,19 +3,34 @@ import streamlit as st
 import pandas as pd
 import geopandas as gpd
 import pydeck as pdk
+import pygeos
 import altair as alt
-from sklearn import preprocessing as pre
 
-from constants import BREAKS, COLOR_RANGE, COLOR_VALUES
+from constants import COLOR_VALUES
+import geometry
+import classification
+import correlation
 import utils
 import queries
 
 
-def color_scale(val: float) -> list:
-    for i, b in enumerate(BREAKS):
-        if val <= b:
-            return COLOR_RANGE[i]
-    return COLOR_RANGE[i]
+def map_scheme() -> str:
+    # Classification scheme picked in the sidebar (see run.run_UI)
+    return st.session_state.get('classification_scheme', classification.DEFAULT_SCHEME)
+
+
+def initial_view_state(coordinates: pd.Series) -> pdk.ViewState:
+    # Centred on the first point of the first non-empty polygon; coordinates are flat [x0, y0, x1, y1, ...] lists
+    first = next((c for c in coordinates if len(c) > 1), None)
+    if first is not None:
+        return pdk.ViewState(
+            **{"latitude": first[1], "longitude": first[0], "zoom": 5, "maxZoom": 16, "pitch": 0, "bearing": 0})
+    return pdk.ViewState(**{"latitude": 36, "longitude": -95, "zoom": 3, "maxZoom": 16, "pitch": 0, "bearing": 0})
+
+
+def layer_columns(df: pd.DataFrame, columns: list) -> pd.DataFrame:
+    # Only what the polygon layer renders or its tooltip shows is serialized into the deck
+    return df[[c for c in dict.fromkeys(['coordinates', 'name', 'fill_color'] + columns) if c in df.columns]]
 
 
 def make_map(geo_df: pd.DataFrame, df: pd.DataFrame, map_feature: str, data_format: str = 'Raw Values',
@@ -35,62 +50,31 @@ def make_map(geo_df: pd.DataFrame, df: pd.DataFrame, map_feature: str, data_form
         label = f"{map_feature} per sqmi"
         df[label] = df[map_feature] / df['sqmi']
 
-    geojson = utils.convert_geom(geo_df_copy, df, [label])
-    geojson_df = pd.DataFrame(geojson)
-
-    geo_df_copy["coordinates"] = geojson_df["features"].apply(lambda row: row["geometry"]["coordinates"])
-    geo_df_copy["name"] = geojson_df["features"].apply(lambda row: row["properties"]["name"])
-    geo_df_copy[label] = geojson_df["features"].apply(lambda row: row["properties"][label])
-    scaler = pre.MinMaxScaler()
+    geo_df_copy = utils.map_frame(geo_df_copy, df, [label], flat=True)
     feat_series = geo_df_copy[label]
-    feat_type = None
-
-    if feat_series.dtype == 'object':
-        try:
-            # feat_dict = {k: (i % 10) / 10 for i, k in enumerate(
-            #     feat_series.unique())}  # max 10 categories, following from constants.BREAK, enumerated rather than encoded
-            # normalized_vals = feat_series.apply(lambda x: feat_dict[x])  # getting normalized vals, manually.
-            color_lookup = pdk.data_utils.assign_random_colors(geo_df_copy[map_feature])
-            geo_df_copy['fill_color'] = geo_df_copy.apply(lambda row: color_lookup.get(row[map_feature]), axis=1)
-        except TypeError:
-            normalized_vals = scaler.fit_transform(
-                pd.DataFrame(feat_series)
-            )
-            colors = list(map(color_scale, normalized_vals))
-            geo_df_copy['fill_color'] = colors
-            geo_df_copy.fillna(0, inplace=True)
-            geo_df_copy = geo_df_copy.astype({label: 'float64'})
+
+    if utils.is_text(feat_series):
+        geo_df_copy['fill_color'] = classification.fill_colors(feat_series)
     else:
-        normalized_vals = scaler.fit_transform(
-            pd.DataFrame(feat_series)
-        )
-        colors = list(map(color_scale, normalized_vals))
-        geo_df_copy['fill_color'] = colors
-        geo_df_copy.fillna(0, inplace=True)
+        geo_df_copy['fill_color'] = classification.fill_colors(feat_series, map_scheme())
+        utils.fill_missing(geo_df_copy, 0)
         geo_df_copy = geo_df_copy.astype({label: 'float64'})
 
 
     tooltip = {"html": ""}
     if 'Census Tract' in set(geo_df_copy.columns):
-        keep_cols = ['coordinates', 'name', 'fill_color', 'geom', map_feature]
-        geo_df_copy.drop(list(set(geo_df_copy.columns) - set(keep_cols)), axis=1, inplace=True)
         tooltip = {"html": "<b>Tract:</b> {name} </br>" + "<b>" + str(label) + ":</b> {" + str(label) + "}"}
     elif 'County Name' in set(geo_df_copy.columns):
-        geo_df_copy.drop(['geom', 'County Name'], axis=1, inplace=True)
         tooltip = {
             "html": "<b>County:</b> {name} </br>" + "<b>" + str(label) + ":</b> {" + str(label) + "}"}
-    if len(geo_df_copy['coordinates'][0][0][0]) > 0:
-        view_state = pdk.ViewState(
-            **{"latitude": geo_df_copy['coordinates'][0][0][0][1], "longitude": geo_df_copy['coordinates'][0][0][0][0],
-               "zoom": 5, "maxZoom": 16, "pitch": 0, "bearing": 0})
-    else:
-        view_state = pdk.ViewState(
-            **{"latitude": 36, "longitude": -95, "zoom": 3, "maxZoom": 16, "pitch": 0, "bearing": 0})
+    view_state = initial_view_state(geo_df_copy['coordinates'])
+    geo_df_copy = layer_columns(geo_df_copy, [map_feature, label])
 
     polygon_layer = pdk.Layer(
         "PolygonLayer",
         geo_df_copy,
         get_polygon="coordinates",
+        position_format='XY',
         filled=True,
         get_fill_color='fill_color',
         stroked=False,
@@ -115,12 +99,17 @@ def make_map(geo_df: pd.DataFrame, df: pd.DataFrame, map_feature: str, data_form
         print(e)
 
 
-def make_correlation_plot(df: pd.DataFrame, feature_cols: list):
-    for feature in feature_cols:
-        feat_type = 'category' if df[feature].dtype == 'object' else 'numerical'
-        if feat_type == 'category':
-            return
-    df = df.astype('float64')
+def make_correlation_plot(df: pd.DataFrame, feature_cols: list, key: str = None, load=None):
+    # Correlations come from correlation.correlation_matrix, cached per dataset under `key` (see
+    # cache.dataset_key). load(columns) fetches the columns the cached matrix doesn't have yet; without it
+    # they're read from df, keyed by its contents when no key is given.
+    if load is None:
+        key = key or correlation.frame_key(df)
+        load = lambda columns: df[columns]
+    avail_cols = list(df.columns) if df is not None else list(feature_cols)
+    matrix = correlation.correlation_matrix(key, feature_cols, load)
+    if any(feature in matrix.skipped for feature in feature_cols):
+        return
     st.subheader('Correlation Plot')
     st.write('''
     This plot shows how individual features in the database correlate to each other. Values range from -1 to 1. 
@@ -129,12 +118,11 @@ def make_correlation_plot(df: pd.DataFrame, feature_cols: list):
     A value of 0 means that the two features are unrelated. A higher value can be read as a stronger relationship 
     (either positive or negative) between the two features.
     ''')
-    avail_cols = list(df.columns)
     avail_cols.sort()
     cols_to_compare = st.multiselect('Columns to consider', avail_cols, feature_cols)
     if len(cols_to_compare) > 2:
-        df_corr = df[cols_to_compare].corr().stack().reset_index().rename(
-            columns={0: 'correlation', 'level_0': 'variable', 'level_1': 'variable2'})
+        matrix = correlation.correlation_matrix(key, cols_to_compare, load)
+        df_corr = correlation.long_frame(matrix.frame(cols_to_compare))
         df_corr['correlation_label'] = df_corr['correlation'].map('{:.2f}'.format)
 
         base = alt.Chart(df_corr).encode(
@@ -163,6 +151,11 @@ def make_correlation_plot(df: pd.DataFrame, feature_cols: list):
 
         st.altair_chart(cor_plot + text)
 
+        with st.expander('Most correlated features'):
+            compared = [c for c in cols_to_compare if c in matrix.columns]
+            feature = st.selectbox('Correlated with', compared, 0)
+            st.table(matrix.top_k(feature, 10, compared).rename('correlation'))
+
 
 def make_chart(df: pd.DataFrame, feature: str, data_format: str = 'Raw Values'):
     data_df = pd.DataFrame(df[[feature, 'County Name']])
@@ -189,10 +182,10 @@ def make_chart(df: pd.DataFrame, feature: str, data_format: str = 'Raw Values'):
 
 
 def make_census_chart(df: pd.DataFrame, feature: str):
-    feat_type = 'category' if df[feature].dtype == 'object' else 'numerical'
+    feat_type = 'category' if utils.is_text(df[feature]) else 'numerical'
     data_df = pd.DataFrame(df[[feature, 'Census Tract', 'county_name']])
     if feat_type == 'category':
-        data_df = pd.DataFrame(data_df.groupby(['county_name', feature]).size())
+        data_df = pd.DataFrame(data_df.groupby(['county_name', feature], observed=True).size())
         data_df = data_df.rename(columns={0: "tract count"})
         data_df = data_df.reset_index()
         bar = alt.Chart(data_df) \
@@ -256,42 +249,19 @@ def make_equity_census_map(geo_df: pd.DataFrame, df: pd.DataFrame, map_feature:
     if 'Census Tract' in df.columns:
         df.reset_index(inplace=True)
     geo_df_copy = geo_df.copy()
-    geojson = utils.convert_geom(geo_df_copy, df, EQUITY_MAP_HEADERS)
-    geojson_df = pd.DataFrame(geojson)
-
-    geo_df_copy["coordinates"] = geojson_df["features"].apply(lambda row: row["geometry"]["coordinates"])
-    geo_df_copy["name"] = geojson_df["features"].apply(lambda row: row["properties"]["name"])
+    geo_df_copy = utils.map_frame(geo_df_copy, df, EQUITY_MAP_HEADERS, flat=True)
 
-    for header in EQUITY_MAP_HEADERS:
-        geo_df_copy[header] = geojson_df["features"].apply(lambda row: row["properties"][header])
-
-    scaler = pre.MinMaxScaler()
     feat_series = geo_df_copy[map_feature]
-    feat_type = None
-    if feat_series.dtype == 'object':
-        feat_type = 'category'
-        feat_dict = {k: (i % 10) / 10 for i, k in enumerate(
-            feat_series.unique())}  # max 10 categories, following from constants.BREAK, enumerated rather than encoded
-        normalized_vals = feat_series.apply(lambda x: feat_dict[x])  # getting normalized vals, manually.
-    else:
-        feat_type = 'numerical'
-        normalized_vals = scaler.fit_transform(
-            pd.DataFrame(feat_series)
-        )
+    feat_type = 'category' if utils.is_text(feat_series) else 'numerical'
+    geo_df_copy['fill_color'] = classification.fill_colors(feat_series, map_scheme())
+    utils.fill_missing(geo_df_copy, 0)
 
-    colors = list(map(color_scale, normalized_vals))
-    geo_df_copy['fill_color'] = colors
-    geo_df_copy.fillna(0, inplace=True)
-
-    for x in range(len(geo_df_copy.index)):
-        geo_df_copy['fill_color'].iloc[x] = [0, 0, 0, 25] if df[map_feature].iloc[
-                                                                 x] == 'Not selected as an Equity Geography' else \
-            geo_df_copy['fill_color'].iloc[x]
+    not_selected = (geo_df_copy[map_feature] == 'Not selected as an Equity Geography').to_numpy()
+    geo_df_copy['fill_color'] = [[0, 0, 0, 25] if grey else color
+                                 for grey, color in zip(not_selected, geo_df_copy['fill_color'])]
 
     tooltip = {"html": ""}
     if 'Census Tract' in set(geo_df_copy.columns):
-        keep_cols = ['coordinates', 'name', 'fill_color', 'geom', map_feature]
-        geo_df_copy.drop(list(set(geo_df_copy.columns) - set(keep_cols)), axis=1, inplace=True)
         if feat_type == 'numerical':
             tooltip = {
                 "html": "<b>Tract ID:</b> {" + str('name') + "} </br>" +
@@ -304,17 +274,11 @@ def make_equity_census_map(geo_df: pd.DataFrame, df: pd.DataFrame, map_feature:
             }
 
     elif 'County Name' in set(geo_df_copy.columns):
-        geo_df_copy.drop(['geom', 'County Name'], axis=1, inplace=True)
         tooltip = {
             "html": "<b>County:</b> {name} </br>" + "<b>" + str(map_feature) + ":</b> {" + str(map_feature) + "}"
         }
-    if len(geo_df_copy['coordinates'][0][0][0]) > 0:
-        view_state = pdk.ViewState(
-            **{"latitude": geo_df_copy['coordinates'][0][0][0][1], "longitude": geo_df_copy['coordinates'][0][0][0][0],
-               "zoom": 5, "maxZoom": 16, "pitch": 0, "bearing": 0})
-    else:
-        view_state = pdk.ViewState(
-            **{"latitude": 36, "longitude": -95, "zoom": 3, "maxZoom": 16, "pitch": 0, "bearing": 0})
+    view_state = initial_view_state(geo_df_copy['coordinates'])
+    geo_df_copy = layer_columns(geo_df_copy, [map_feature])
 
     if feat_type == 'numerical':
         geo_df_copy = geo_df_copy.astype({map_feature: 'float64'})
@@ -323,6 +287,7 @@ def make_equity_census_map(geo_df: pd.DataFrame, df: pd.DataFrame, map_feature:
         "PolygonLayer",
         geo_df_copy,
         get_polygon="coordinates",
+        position_format='XY',
         filled=True,
         get_fill_color='fill_color',
         stroked=False,
@@ -348,36 +313,15 @@ def make_transport_census_map(geo_df: pd.DataFrame, df: pd.DataFrame, map_featur
     if 'Census Tract' in df.columns:
         df.reset_index(inplace=True)
     geo_df_copy = geo_df.copy()
-    geojson = utils.convert_geom(geo_df_copy[subset], df, list(set(df.columns)-set(subset)))
-    geojson_df = pd.DataFrame(geojson)
-    geo_df_copy["coordinates"] = geojson_df["features"].apply(lambda row: row["geometry"]["coordinates"])
-    geo_df_copy["name"] = geojson_df["features"].apply(lambda row: row["properties"]["name"])
-
-    for header in list(set(df.columns)-set(subset)):
-        geo_df_copy[header] = geojson_df["features"].apply(lambda row: row["properties"][header])
+    geo_df_copy = utils.map_frame(geo_df_copy[subset], df, list(set(df.columns)-set(subset)), flat=True)
 
-    scaler = pre.MinMaxScaler()
     feat_series = geo_df_copy[map_feature]
-    feat_type = None
-    if feat_series.dtype == 'object':
-        feat_type = 'category'
-        feat_dict = {k: (i % 10) / 10 for i, k in enumerate(
-            feat_series.unique())}  # max 10 categories, following from constants.BREAK, enumerated rather than encoded
-        normalized_vals = feat_series.apply(lambda x: feat_dict[x])  # getting normalized vals, manually.
-    else:
-        feat_type = 'numerical'
-        normalized_vals = scaler.fit_transform(
-            pd.DataFrame(feat_series)
-        )
-
-    colors = list(map(color_scale, normalized_vals))
-    geo_df_copy['fill_color'] = colors
-    geo_df_copy.fillna(0, inplace=True)
+    feat_type = 'category' if utils.is_text(feat_series) else 'numerical'
+    geo_df_copy['fill_color'] = classification.fill_colors(feat_series, map_scheme())
+    utils.fill_missing(geo_df_copy, 0)
 
     tooltip = {"html": ""}
     if 'Census Tract' in set(geo_df_copy.columns):
-        keep_cols = ['coordinates', 'name', 'fill_color', 'geom', map_feature]
-        geo_df_copy.drop(list(set(geo_df_copy.columns) - set(keep_cols)), axis=1, inplace=True)
         if map_feature == 'Index Value':
             tooltip = {
                 "html": "<b>Tract ID:</b> {" + str('name') + "} </br>" +
@@ -389,13 +333,8 @@ def make_transport_census_map(geo_df: pd.DataFrame, df: pd.DataFrame, map_featur
                         "<b>" + str(map_feature) + ":</b> {" + str(map_feature) + "}"+ queries.TABLE_UNITS[map_feature]+" </br>"
             }
 
-    if len(geo_df_copy['coordinates'][0][0][0]) > 0:
-        view_state = pdk.ViewState(
-            **{"latitude": geo_df_copy['coordinates'][0][0][0][1], "longitude": geo_df_copy['coordinates'][0][0][0][0],
-               "zoom": 5, "maxZoom": 16, "pitch": 0, "bearing": 0})
-    else:
-        view_state = pdk.ViewState(
-            **{"latitude": 36, "longitude": -95, "zoom": 3, "maxZoom": 16, "pitch": 0, "bearing": 0})
+    view_state = initial_view_state(geo_df_copy['coordinates'])
+    geo_df_copy = layer_columns(geo_df_copy, [map_feature])
 
     if feat_type == 'numerical':
         geo_df_copy = geo_df_copy.astype({map_feature: 'float64'})
@@ -405,6 +344,7 @@ def make_transport_census_map(geo_df: pd.DataFrame, df: pd.DataFrame, map_featur
             "PolygonLayer",
             geo_df_copy,
             get_polygon="coordinates",
+            position_format='XY',
             filled=True,
             get_fill_color=[244, 211, 94],
             stroked=False,
@@ -432,6 +372,7 @@ def make_transport_census_map(geo_df: pd.DataFrame, df: pd.DataFrame, map_featur
             "PolygonLayer",
             geo_df_copy,
             get_polygon="coordinates",
+            position_format='XY',
             filled=True,
             get_fill_color='fill_color',
             stroked=False,
@@ -459,11 +400,11 @@ def make_equity_census_chart(df: pd.DataFrame, threshold: dict, average: dict, f
                               {"name": 'concentration threshold', "value": threshold[feature]}])
 
     feature = feature + ' (%)'
-    feat_type = 'category' if df[feature].dtype == 'object' else 'numerical'
+    feat_type = 'category' if utils.is_text(df[feature]) else 'numerical'
     data_df = pd.DataFrame(df[[feature, 'Census Tract', 'county_name']])
 
     if feat_type == 'category':
-        data_df = pd.DataFrame(data_df.groupby(['county_name', feature]).size())
+        data_df = pd.DataFrame(data_df.groupby(['county_name', feature], observed=True).size())
         data_df = data_df.rename(columns={0: "tract count"})
         data_df = data_df.reset_index()
         bar = alt.Chart(data_df) \
@@ -502,11 +443,11 @@ def make_transport_census_chart(df: pd.DataFrame, average: dict, feature: str):
 
     baselines = pd.DataFrame([{"name": 'county average', "value": average[feature]}])
 
-    feat_type = 'category' if df[feature].dtype == 'object' else 'numerical'
+    feat_type = 'category' if utils.is_text(df[feature]) else 'numerical'
     data_df = pd.DataFrame(df[[feature, 'Census Tract', 'county_name']])
 
     if feat_type == 'category':
-        data_df = pd.DataFrame(data_df.groupby(['county_name', feature]).size())
+        data_df = pd.DataFrame(data_df.groupby(['county_name', feature], observed=True).size())
         data_df = data_df.rename(columns={0: "tract count"})
         data_df = data_df.reset_index()
         bar = alt.Chart(data_df) \
@@ -601,26 +542,30 @@ def make_simple_chart(df: pd.DataFrame, feature: str):
 
 def make_transit_layers(tract_df: pd.DataFrame, pickable: bool = True):
     tracts = tract_df['Census Tract'].to_list()
-    tracts_str = str(tuple(tracts)).replace(',)', ')')
 
-    NTM_shapes = queries.get_transit_shapes_geoms(
-        columns=['route_desc', 'route_type_text', 'length', 'geom', 'tract_id', 'route_long_name'],
-        where=f" tract_id IN {tracts_str}")
+    shape_columns = ['route_desc', 'route_type_text', 'length', 'tract_id', 'route_long_name']
+    # Paths come precomputed at a level of detail suited to the number of shapes when the geometry store is built
+    NTM_shapes = geometry.read_geometries('ntm_shapes', shape_columns, filters=[('tract_id', 'in', tracts)],
+                                          coordinates=True, unique=True)
+    if NTM_shapes is not None:
+        NTM_shapes.rename(columns={'geom': 'path'}, inplace=True)
+    else:
+        NTM_shapes = queries.get_transit_shapes_geoms(columns=shape_columns + ['geom'], tract_ids=tracts)
 
-    tolerance = 0.0000750
-    NTM_shapes['geom'] = NTM_shapes['geom'].apply(lambda x: x.simplify(tolerance, preserve_topology=False))
+        tolerance = 0.0000750
+        geoms = pygeos.simplify(utils.geoms_from_shapely(NTM_shapes['geom']), tolerance, preserve_topology=False)
+        NTM_shapes['geom'] = utils.to_geoseries(geoms, index=NTM_shapes.index)
+        NTM_shapes['path'] = utils.line_paths(geoms)
 
     NTM_stops = queries.get_transit_stops_geoms(columns=['stop_name', 'stop_lat', 'stop_lon', 'geom'],
-                                                where=f" tract_id IN {tracts_str}")
+                                                tract_ids=tracts)
 
-    NTM_shapes.drop_duplicates(subset=['geom'])
     NTM_stops.drop_duplicates(subset=['geom'])
 
     if NTM_shapes.empty:
         st.write("Transit lines have not been identified for Equity Geographies in this region.")
         line_layer = None
     else:
-        NTM_shapes['path'] = NTM_shapes['geom'].apply(utils.coord_extractor)
         NTM_shapes.fillna("N/A", inplace=True)
 
         route_colors = {}